@@ -0,0 +1,231 @@
+"""
+Offline batch processor: converts every PDF under a directory to a Word document.
+
+Progress is recorded in a JSONL manifest, one record per document. An interrupted run
+started again with the same manifest skips the documents that already finished.
+
+Example:
+    python batch_convert.py archive/ --template word/template.docx --workers 4
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import pdf_to_word_api
+
+# Manifest statuses that mean a document does not need to be processed again. "partial" documents,
+# whose batches for some pages kept failing, are processed again and resume from their checkpoints.
+FINISHED_STATUSES = ("done", "no_changes")
+
+
+def find_pdfs(input_dir):
+    """Returns the paths of all PDFs under input_dir, relative to it, in a stable order."""
+    pdfs = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(".pdf"):
+                pdfs.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return pdfs
+
+
+def load_manifest(manifest_path):
+    """Returns the latest manifest record per document path. Unreadable lines from an interrupted write are skipped."""
+    records = {}
+    if not os.path.exists(manifest_path):
+        return records
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                records[record["pdf"]] = record
+            except (ValueError, KeyError):
+                continue
+    return records
+
+
+class Manifest:
+    """Appends one JSON record per line to the manifest, flushing after each so progress survives a crash."""
+
+    def __init__(self, manifest_path):
+        self._file = open(manifest_path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def convert_one(input_dir, relative_path, doc_hash, template_path, output_dir, router, hedge_policy, token_budget=None,
+                on_late_tokens=None):
+    """
+    Converts one PDF and returns its manifest record. Documents whose estimate exceeds token_budget are skipped,
+    and documents with pages that could not be extracted are recorded as partial without writing a Word document.
+    Tokens that cancelled hedged work uses after the record is made are passed to on_late_tokens.
+    """
+    pdf_path = os.path.join(input_dir, relative_path)
+    pdf_filename = os.path.basename(relative_path)
+    start = time.monotonic()
+    record = {"pdf": relative_path, "sha256": doc_hash}
+    try:
+        plan = None
+        if token_budget is not None:
+            plan = pdf_to_word_api.plan_extraction(pdf_to_word_api.estimate_tokens(pdf_path), token_budget)
+            record["extraction_plan"] = plan
+
+        if token_budget is not None and plan is None:
+            record["status"] = "over_budget"
+            record["token_usage"] = 0
+        else:
+            dpi, detail = pdf_to_word_api.degrade_steps[0]
+            if plan is not None:
+                dpi, detail = plan["dpi"], plan["detail"]
+            changes, token_usage = pdf_to_word_api.extract_changes(
+                pdf_path, pdf_filename, router, hedge_policy, pdf_to_word_api.hedge_deadline, dpi, detail,
+                vision=plan is None or plan["mode"] == "vision", on_late_tokens=on_late_tokens,
+                token_budget=token_budget)
+            record["token_usage"] = token_usage
+            record["total_changes"] = len(changes)
+            if changes:
+                # Mirror the input layout so documents with the same name in different folders don't collide
+                result_dir = os.path.join(output_dir, os.path.dirname(relative_path))
+                word_filename, result_path = pdf_to_word_api.save_word_document(
+                    template_path, changes, pdf_filename, result_dir)
+                pdf_to_word_api.log_api_call(
+                    pdf_filename, word_filename, f"Azure OpenAI API: {router.describe()}", token_usage)
+                record["status"] = "done"
+                record["word_path"] = result_path
+            else:
+                record["status"] = "no_changes"
+    except pdf_to_word_api.IncompleteExtraction as e:
+        record["status"] = "partial"
+        record["incomplete_pages"] = e.incomplete_pages
+        record["token_usage"] = e.token_usage
+        record["total_changes"] = len(e.changes)
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = str(e)
+        record.setdefault("token_usage", 0)
+    record["seconds"] = round(time.monotonic() - start, 2)
+    record["timestamp"] = datetime.now().isoformat()
+    return record
+
+
+def run(input_dir, template_path, output_dir, manifest_path, workers, hedge_policy, token_budget=None):
+    """Processes all unfinished PDFs under input_dir and prints throughput and token totals."""
+    previous = load_manifest(manifest_path)
+    pending = []
+    skipped = 0
+    for relative_path in find_pdfs(input_dir):
+        doc_hash = pdf_to_word_api.document_hash(os.path.join(input_dir, relative_path))
+        record = previous.get(relative_path)
+        if record and record.get("status") in FINISHED_STATUSES and record.get("sha256") == doc_hash:
+            skipped += 1
+        else:
+            pending.append((relative_path, doc_hash))
+
+    print(f"{len(pending)} documents to process, {skipped} already finished according to {manifest_path}")
+
+    router = pdf_to_word_api.router
+    if hedge_policy != "off" and pdf_to_word_api.hedge_workers < 2 * workers:
+        # Both paths of every document in progress need a thread, or they queue and eat into the hedge deadline
+        pdf_to_word_api.hedge_workers = 2 * workers
+    manifest = Manifest(manifest_path)
+    counts = {"done": 0, "no_changes": 0, "partial": 0, "failed": 0, "over_budget": 0}
+    total_token_usage = 0
+    late_token_usage = [0]
+    late_lock = threading.Lock()
+
+    def on_late_tokens(tokens):
+        with late_lock:
+            late_token_usage[0] += tokens
+
+    def record_result(future):
+        nonlocal total_token_usage
+        recorded.add(future)
+        record = future.result()
+        manifest.append(record)
+        counts[record["status"]] += 1
+        total_token_usage += record.get("token_usage", 0)
+        finished = sum(counts.values())
+        print(f"[{finished}/{len(pending)}] {record['status']}: {record['pdf']} "
+              f"({record['seconds']}s, {record.get('token_usage', 0)} tokens)")
+
+    start = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {}
+    recorded = set()
+    try:
+        futures = {
+            executor.submit(convert_one, input_dir, relative_path, doc_hash, template_path, output_dir,
+                            router, hedge_policy, token_budget, on_late_tokens): relative_path
+            for relative_path, doc_hash in pending
+        }
+        for future in as_completed(futures):
+            record_result(future)
+    except KeyboardInterrupt:
+        print("Interrupted, waiting for documents in progress; run again with the same manifest to resume")
+        executor.shutdown(wait=True, cancel_futures=True)
+        # Documents that finished meanwhile may have written their Word document, so they must not run again
+        for future in futures:
+            if future not in recorded and not future.cancelled() and future.exception() is None:
+                record_result(future)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        manifest.close()
+        # Count the tokens of cancelled hedged work that was still in flight
+        pdf_to_word_api.wait_for_hedged_work()
+        total_token_usage += late_token_usage[0]
+
+        elapsed = time.monotonic() - start
+        processed = sum(counts.values())
+        print(f"Processed {processed} documents in {elapsed:.1f}s "
+              f"({processed / elapsed * 3600 if elapsed else 0:.1f} documents/hour): "
+              f"{counts['done']} converted, {counts['no_changes']} without changes, {counts['partial']} partial, "
+              f"{counts['failed']} failed, {counts['over_budget']} over the token budget")
+        print(f"Total token usage: {total_token_usage}"
+              f" ({total_token_usage // processed if processed else 0} per document,"
+              f" {late_token_usage[0]} from cancelled hedged work)")
+
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a directory of PDFs with tracked changes to Word documents.")
+    parser.add_argument("input_dir", help="Directory searched recursively for PDF files")
+    parser.add_argument("--template", default=os.path.join("word", "template.docx"), help="Word template to fill")
+    parser.add_argument("--output-dir", default="result", help="Directory the Word documents are written to")
+    parser.add_argument("--manifest", default="batch_manifest.jsonl", help="JSONL progress manifest used to resume")
+    parser.add_argument("--workers", type=int, default=4, help="Number of documents processed in parallel")
+    parser.add_argument("--hedge", default=pdf_to_word_api.hedge_policy, choices=pdf_to_word_api.hedge_policies,
+                        help="Hedge policy for the vision and text-layer extraction")
+    parser.add_argument("--token-budget", type=int, default=pdf_to_word_api.token_budget,
+                        help="Per-document token budget; documents are degraded to fit or skipped")
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    try:
+        pdf_to_word_api.validate_token_budget(args.token_budget, "--token-budget (default TOKEN_BUDGET)")
+    except ValueError as e:
+        parser.error(str(e))
+    if not pdf_to_word_api.api_key:
+        parser.error("AZURE_OPENAI_API_KEY is not set")
+
+    counts = run(args.input_dir, args.template, args.output_dir, args.manifest, args.workers, args.hedge,
+                 args.token_budget)
+    return 1 if counts["failed"] or counts["partial"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
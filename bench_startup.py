@@ -0,0 +1,167 @@
+"""
+Startup benchmark: how long a new worker takes until it has served its first request and can convert a
+document, as when an instance starts on scale-out. Each run times three phases:
+
+    startup        from process start (or fork) until the app is ready to serve
+    first_request  POST /convert without files, answered with 400; the same request works on every version
+    convert_ready  importing the modules a first conversion needs (python-docx, pdf2image, pdfplumber,
+                   pypdfium2, requests); the conversion itself calls Azure OpenAI and is not timed
+
+Scenarios:
+
+    baseline   the module before the app factory, from the repository's first commit; it imports everything
+               and builds the app at import time
+    lazy       a fresh interpreter, heavy modules loaded on first use (GUNICORN_PRELOAD=0)
+    eager      a fresh interpreter importing the heavy modules before create_app()
+    preforked  a worker forked from a master that ran import_heavy_modules() and create_app(), then warmed up
+               as in gunicorn.conf.py's post_fork; this is a worker started by gunicorn with preload_app
+
+Example:
+    python bench_startup.py --runs 10 --output bench_output.txt
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CONVERT_MODULES = ("docx", "pdf2image", "pdfplumber", "pypdfium2", "requests")
+
+# Serves the first request and loads the conversion modules; `start` and `started` are set by the scenario
+FIRST_REQUEST = """
+response = app.test_client().post("/convert", data={{}})
+assert response.status_code == 400, response.status_code
+served = time.perf_counter()
+for module in {modules!r}:
+    importlib.import_module(module)
+ready = time.perf_counter()
+timings = json.dumps({{"startup": started - start, "first_request": served - started, "convert_ready": ready - served}})
+"""
+
+FRESH = """
+import importlib, json, sys, time
+start = time.perf_counter()
+{setup}
+started = time.perf_counter()
+""" + FIRST_REQUEST + """
+print(timings)
+"""
+
+SCENARIOS = {
+    "baseline": "sys.path.insert(0, {baseline_dir!r}); import pdf_to_word_api_baseline; app = pdf_to_word_api_baseline.app",
+    "lazy": "import pdf_to_word_api; app = pdf_to_word_api.create_app()",
+    "eager": "import pdf_to_word_api; pdf_to_word_api.import_heavy_modules(); app = pdf_to_word_api.create_app()",
+}
+
+PREFORKED = """
+import importlib, json, os, time
+import pdf_to_word_api
+pdf_to_word_api.import_heavy_modules()  # on_starting
+app = pdf_to_word_api.create_app()  # preload_app
+for _ in range({runs}):
+    read_fd, write_fd = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        app.extensions["deployment_router"].session()  # post_fork
+        pdf_to_word_api.hedge_executor()
+        started = time.perf_counter()
+""" + "\n".join("        " + line for line in FIRST_REQUEST.strip().splitlines()) + """
+        os.write(write_fd, (timings + "\\n").encode())
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        print(f.read().strip())
+    os.waitpid(pid, 0)
+"""
+
+PHASES = ("startup", "first_request", "convert_ready", "total")
+
+
+def run_python(code):
+    """Runs code in a fresh interpreter in the repository and returns the timings it prints, one dict per line."""
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=HERE,
+        # The app needs a key to start; no request reaches Azure OpenAI
+        env=dict(os.environ, AZURE_OPENAI_API_KEY=os.environ.get("AZURE_OPENAI_API_KEY") or "benchmark"),
+        capture_output=True, text=True, check=True,
+    ).stdout
+    timings = [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+    for run in timings:
+        run["total"] = run["startup"] + run["first_request"] + run["convert_ready"]
+    return timings
+
+
+def export_baseline(baseline_dir):
+    """Writes the module from the repository's first commit to baseline_dir. Returns False without git history."""
+    try:
+        root = subprocess.run(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.split()[0]
+        source = subprocess.run(["git", "show", f"{root}:pdf_to_word_api.py"], cwd=HERE,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, IndexError, subprocess.CalledProcessError):
+        return False
+    with open(os.path.join(baseline_dir, "pdf_to_word_api_baseline.py"), "w", encoding="utf-8") as f:
+        f.write(source)
+    return True
+
+
+def measure(runs, baseline_dir):
+    """Returns the timings of every scenario that can run here, as {scenario: [timings per run]}."""
+    results = {}
+    for scenario, setup in SCENARIOS.items():
+        if scenario == "baseline" and not export_baseline(baseline_dir):
+            print("Skipping baseline: git history not available")
+            continue
+        code = FRESH.format(setup=setup.format(baseline_dir=baseline_dir), modules=CONVERT_MODULES)
+        results[scenario] = [run for _ in range(runs) for run in run_python(code)]
+
+    if hasattr(os, "fork"):
+        results["preforked"] = run_python(PREFORKED.format(runs=runs, modules=CONVERT_MODULES))
+    else:
+        print("Skipping preforked: os.fork is not available on this platform")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold start time of the PDF to Word app.")
+    parser.add_argument("--runs", type=int, default=10, help="Workers started per scenario")
+    parser.add_argument("--output", help="CSV file the results are appended to")
+    args = parser.parse_args(argv)
+
+    baseline_dir = tempfile.mkdtemp()
+    try:
+        measured = measure(args.runs, baseline_dir)
+    finally:
+        shutil.rmtree(baseline_dir, ignore_errors=True)
+
+    results = []
+    for scenario, timings in measured.items():
+        result = {"timestamp": datetime.now().isoformat(), "scenario": scenario, "runs": len(timings)}
+        for phase in PHASES:
+            result[f"{phase}_median_ms"] = round(statistics.median(t[phase] for t in timings) * 1000, 1)
+        result["total_min_ms"] = round(min(t["total"] for t in timings) * 1000, 1)
+        result["total_max_ms"] = round(max(t["total"] for t in timings) * 1000, 1)
+        results.append(result)
+        print(f"{scenario:>9}: " + ", ".join(f"{phase} {result[f'{phase}_median_ms']} ms" for phase in PHASES)
+              + f" (median of {len(timings)} runs)")
+
+    if args.output:
+        with open(args.output, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            if f.tell() == 0:
+                writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == "__main__":
+    main()
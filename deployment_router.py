@@ -0,0 +1,258 @@
+import os
+import random
+import threading
+import time
+
+# Client errors caused by the request itself, e.g. a prompt over the context length. Every deployment
+# would reject it too, so they fail the call instead of failing over.
+REJECTED_STATUS_CODES = (400, 413, 422)
+
+
+class RequestRejected(Exception):
+    """Raised when a deployment rejects the request itself rather than failing to serve it."""
+
+
+class Deployment:
+    """One Azure OpenAI deployment and what we have observed about it."""
+
+    def __init__(self, deployment_id, endpoint, api_key, api_version):
+        self.deployment_id = deployment_id
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.api_version = api_version
+        self.latency = None  # Moving average of response time in seconds
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.quota_observed_at = None  # When the remaining quota was read from the response headers
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.outstanding = 0  # Requests currently in flight
+
+    @property
+    def name(self):
+        return f"{self.deployment_id}@{self.endpoint}"
+
+    @property
+    def url(self):
+        return f"{self.endpoint}openai/deployments/{self.deployment_id}/chat/completions?api-version={self.api_version}"
+
+    def quota_exhausted(self):
+        return self.remaining_requests == 0 or self.remaining_tokens == 0
+
+
+class DeploymentRouter:
+    """
+    Routes chat completion calls across tiers of Azure OpenAI deployments.
+    Tiers are ordered from cheapest to strongest: a call goes to the first tier and only
+    escalates when the response fails validation or every deployment in the tier errors.
+    Within a tier, load is spread with a weighted random choice that favours deployments with
+    low observed latency, few requests in flight and plenty of remaining quota, and deployments
+    that return errors are put on cooldown (failover). Deployments cooling down are skipped while
+    another tier can serve the call, and only tried as a last resort.
+    Quota headers describe a rate limit window, so they are ignored after `quota_max_age` seconds.
+    """
+
+    def __init__(self, tiers, endpoint, api_key, api_version, latency_smoothing=0.3,
+                 failure_cooldown=30, max_cooldown=300, quota_max_age=60, request_timeout=120, pool_size=16):
+        self.tiers = []
+        for tier in tiers:
+            self.tiers.append([
+                Deployment(
+                    entry["deployment_id"],
+                    entry.get("endpoint", endpoint),
+                    entry.get("api_key", api_key),
+                    entry.get("api_version", api_version),
+                )
+                for entry in tier
+            ])
+        self.latency_smoothing = latency_smoothing
+        self.failure_cooldown = failure_cooldown
+        self.max_cooldown = max_cooldown
+        self.quota_max_age = quota_max_age
+        self.request_timeout = request_timeout
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._session = None
+        self._session_pid = None
+        self._random = random.Random()
+
+    def session(self):
+        """
+        Returns the HTTP session used for all deployments, so connections to the endpoints are reused.
+        It is created on first use in each process: a session must not be shared across a fork.
+        """
+        with self._lock:
+            if self._session is None or self._session_pid != os.getpid():
+                import requests
+                self._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                self._session.mount("https://", adapter)
+                self._session.mount("http://", adapter)
+                self._session_pid = os.getpid()
+            return self._session
+
+    def describe(self):
+        """Short description of the cascade for logging, e.g. 'chat-gpt-4o-mini > chat-gpt-4o'."""
+        return " > ".join("|".join(d.deployment_id for d in tier) for tier in self.tiers)
+
+    def candidates(self, tier):
+        """
+        Orders the deployments of a tier that are not cooling down for one call. Available deployments come
+        first, in a weighted random order (see `weight`); deployments out of quota come last.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for d in tier:
+                if d.quota_observed_at is not None and now - d.quota_observed_at > self.quota_max_age:
+                    # The rate limit window has reset since, so the quota is unknown again
+                    d.remaining_requests = d.remaining_tokens = d.quota_observed_at = None
+            available = [d for d in tier if d.cooldown_until <= now and not d.quota_exhausted()]
+            exhausted = [d for d in tier if d.cooldown_until <= now and d.quota_exhausted()]
+
+            known_latencies = [d.latency for d in tier if d.latency is not None]
+            default_latency = sum(known_latencies) / len(known_latencies) if known_latencies else 1.0
+            known_tokens = [d.remaining_tokens for d in tier if d.remaining_tokens is not None]
+            max_tokens = max(known_tokens) if known_tokens else None
+            weights = {id(d): self.weight(d, default_latency, max_tokens) for d in available}
+
+            # Weighted sampling without replacement
+            ordered = []
+            while available:
+                choice = self._random.choices(available, weights=[weights[id(d)] for d in available])[0]
+                available.remove(choice)
+                ordered.append(choice)
+            return ordered + exhausted
+
+    def cooling_down(self, tier):
+        """Returns the deployments of a tier cooling down after errors, the one available soonest first."""
+        now = time.monotonic()
+        with self._lock:
+            return sorted((d for d in tier if d.cooldown_until > now), key=lambda d: d.cooldown_until)
+
+    def weight(self, deployment, default_latency, max_tokens):
+        """
+        Share of the load a deployment should get: inversely proportional to its latency and to the requests it
+        has in flight, and proportional to its remaining tokens relative to the deployment with the most.
+        Deployments not measured yet are treated as having the tier's average latency and full quota.
+        """
+        latency = deployment.latency if deployment.latency is not None else default_latency
+        quota = 1.0
+        if deployment.remaining_tokens is not None and max_tokens:
+            quota = deployment.remaining_tokens / max_tokens
+        return quota / (max(latency, 0.01) * (1 + deployment.outstanding))
+
+    def _record_success(self, deployment, elapsed, response):
+        with self._lock:
+            if deployment.latency is None:
+                deployment.latency = elapsed
+            else:
+                deployment.latency += self.latency_smoothing * (elapsed - deployment.latency)
+            deployment.remaining_requests = _header_int(response, "x-ratelimit-remaining-requests")
+            deployment.remaining_tokens = _header_int(response, "x-ratelimit-remaining-tokens")
+            deployment.quota_observed_at = time.monotonic()
+            deployment.consecutive_failures = 0
+            deployment.cooldown_until = 0.0
+
+    def _record_failure(self, deployment, response=None):
+        with self._lock:
+            deployment.consecutive_failures += 1
+            cooldown = self.failure_cooldown * deployment.consecutive_failures
+            retry_after = _header_int(response, "retry-after") if response is not None else None
+            if retry_after is not None:
+                cooldown = retry_after
+            deployment.cooldown_until = time.monotonic() + min(cooldown, self.max_cooldown)
+
+    def post(self, deployment, payload):
+        """Sends one chat completion request to a deployment and records latency, quota and failures."""
+        import requests
+
+        headers = {
+            "Content-Type": "application/json",
+            "api-key": deployment.api_key
+        }
+        session = self.session()
+        with self._lock:
+            deployment.outstanding += 1
+        start = time.monotonic()
+        try:
+            response = session.post(deployment.url, headers=headers, json=payload, timeout=self.request_timeout)
+        except requests.RequestException:
+            self._record_failure(deployment)
+            raise
+        finally:
+            with self._lock:
+                deployment.outstanding -= 1
+
+        if response.status_code in REJECTED_STATUS_CODES:
+            raise RequestRejected(f"Azure OpenAI API rejected the request to {deployment.name}: "
+                                  f"{response.status_code}, {response.text}")
+        if response.status_code != 200:
+            self._record_failure(deployment, response)
+            raise Exception(f"Azure OpenAI API error from {deployment.name}: {response.status_code}, {response.text}")
+
+        self._record_success(deployment, time.monotonic() - start, response)
+        return response.json()
+
+    def complete(self, payload, validate):
+        """
+        Runs a chat completion through the cascade.
+        `validate` receives the response content and returns the parsed result, or raises
+        ValueError when the output is not acceptable, in which case the next tier is tried.
+        Returns (result, token_usage, deployment_id), with token usage summed over all attempts.
+        Raises RequestRejected without trying other deployments when the request itself is invalid.
+        """
+        total_token_usage = 0
+        last_error = None
+        for deployments in self._attempt_order():
+            for deployment in deployments:
+                try:
+                    response_json = self.post(deployment, payload)
+                except RequestRejected:
+                    raise
+                except Exception as e:
+                    print(f"Deployment {deployment.name} failed, failing over: {e}")
+                    last_error = e
+                    continue
+
+                total_token_usage += (response_json.get('usage') or {}).get('total_tokens', 0)
+                try:
+                    # content is None when the response was blocked by the content filter
+                    response_content = response_json['choices'][0]['message']['content']
+                    if response_content is None:
+                        raise ValueError(f"No content, finish_reason {response_json['choices'][0].get('finish_reason')}")
+                    return validate(response_content.strip()), total_token_usage, deployment.deployment_id
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                    print(f"Output from {deployment.deployment_id} failed validation: {e}")
+                    last_error = e
+                    # A valid HTTP response with bad output escalates to the next tier
+                    break
+
+        raise Exception(f"All deployments failed: {last_error}")
+
+    def _attempt_order(self):
+        """
+        Yields the groups of deployments complete() tries in turn: the candidates of each tier, then each
+        deployment that was skipped because it was cooling down, as a last resort.
+        """
+        last_resort = []
+        for tier_index, tier in enumerate(self.tiers):
+            if tier_index:
+                print(f"Escalating to tier {tier_index + 1}/{len(self.tiers)}")
+            last_resort.extend(self.cooling_down(tier))
+            yield self.candidates(tier)
+
+        if last_resort:
+            print(f"Trying {len(last_resort)} deployments cooling down as a last resort")
+        for deployment in sorted(last_resort, key=lambda d: d.cooldown_until):
+            yield [deployment]
+
+
+def _header_int(response, name):
+    """Reads an integer response header, returning None when absent or malformed."""
+    if response is None:
+        return None
+    value = response.headers.get(name)
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,28 @@
+import os
+
+# Run with: gunicorn -c gunicorn.conf.py
+wsgi_app = "pdf_to_word_api:create_app()"
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+# Each hedged request runs two paths at once, so they never queue behind other requests for a thread
+os.environ.setdefault("HEDGE_WORKERS", str(2 * threads))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 600))  # Long documents take minutes
+
+# Load the app once in the master; workers are forked from it already warm
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+
+def on_starting(server):
+    if preload_app:
+        import pdf_to_word_api
+        pdf_to_word_api.import_heavy_modules()
+
+
+def post_fork(server, worker):
+    # HTTP sessions and thread pools must not be shared across a fork, so each worker creates its own
+    if preload_app:
+        import pdf_to_word_api
+        app = server.app.wsgi()
+        app.extensions["deployment_router"].session()
+        pdf_to_word_api.hedge_executor()
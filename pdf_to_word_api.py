@@ -1,31 +1,145 @@
-import unittest
-from flask import Flask, request, send_file, Response
-from unittest.mock import MagicMock
-from docx import Document, text
-from docx.shared import RGBColor
+from flask import Blueprint, Flask, Response, current_app, request
 import os
 import csv
 from datetime import datetime
 import io, json
-import pdfplumber
-import requests
 import tempfile
-from pdf2image import convert_from_path  # Added for PDF to image conversion
 import base64
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from deployment_router import DeploymentRouter
+import token_estimator
 
-app = Flask(__name__)
+# pdfplumber, pdf2image, python-docx and requests are imported where they are used, so that starting
+# the app (and scaling out) doesn't pay for them. See import_heavy_modules() for gunicorn preload.
+
+bp = Blueprint("pdf_to_word", __name__)
+
+# Azure OpenAI configuration, read from the environment
+endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT", "https://openai-eus-ti-poc-shared-resources.openai.azure.com/")
+api_key = os.environ.get("AZURE_OPENAI_API_KEY")  # Required; create_app() refuses to start without it
+deployment_id = os.environ.get("AZURE_OPENAI_DEPLOYMENT", "chat-gpt-4o")  # or "chat-gpt-4o-mini"
+api_version = os.environ.get("AZURE_OPENAI_API_VERSION", "2025-01-01-preview")
+
+# Deployment tiers, cheapest first. A batch is sent to the first tier and escalates to the next
+# only when the output fails validation. Each tier may list several deployments or endpoints
+# ("endpoint", "api_key" and "api_version" default to the values above); load is spread across
+# them by observed latency and remaining quota, failing over when one returns errors.
+# AZURE_OPENAI_DEPLOYMENT_TIERS may hold the same structure as JSON, replacing the default tiers.
+def build_deployment_tiers(tiers, deployment):
+    """Returns `tiers` (a list of tiers or its JSON), or by default chat-gpt-4o-mini escalating to `deployment`."""
+    if isinstance(tiers, str):
+        tiers = json.loads(tiers)
+    return tiers or [
+        [{"deployment_id": "chat-gpt-4o-mini"}],
+        [{"deployment_id": deployment}],
+    ]
+
+
+custom_deployment_tiers = os.environ.get("AZURE_OPENAI_DEPLOYMENT_TIERS")
+deployment_tiers = build_deployment_tiers(custom_deployment_tiers, deployment_id)
+
+# Router used outside the web app, e.g. by batch_convert.py; create_app() builds one per app
+router = DeploymentRouter(deployment_tiers, endpoint, api_key, api_version)
+
+# Hedged execution of the vision pipeline and the text-layer extraction:
+#   "off"      - run the text-layer extraction only after the vision pass finds no changes
+#   "first"    - run both at once and take the first non-empty result
+#   "deadline" - run both at once and take the vision result if it arrives within hedge_deadline seconds
+#   "merge"    - run both at once and merge the changes per paragraph, preferring the vision result
+# Requests can override the policy with the "hedge" form field.
+hedge_policies = ("off", "first", "deadline", "merge")
+hedge_policy = os.environ.get("HEDGE_POLICY", "off")
+hedge_deadline = float(os.environ.get("HEDGE_DEADLINE", 60))  # seconds
+hedge_workers = int(os.environ.get("HEDGE_WORKERS", 8))  # Threads shared by all hedged requests of a process
+
+# Per-batch checkpoints of the vision extraction, keyed by document hash and page range.
+# Failed batches are retried on their own, and a resubmitted document only pays for unfinished pages.
+checkpoint_dir = os.environ.get("CHECKPOINT_DIR", os.path.join(os.path.dirname(__file__), 'outputs', 'checkpoints'))
+batch_retries = 2
+batch_retry_delay = 5  # seconds, multiplied by the retry round
+
+# Pages are sent to the vision extraction in batches to avoid exceeding token limits
+batch_size = 4  # Adjust based on token usage and performance
+
+# Pre-flight token budget. Requests may pass a "token_budget" form field; when the estimate exceeds it,
+# the extraction is degraded through these (dpi, detail) rendering steps, then to text-layer extraction
+# only, and refused if even that does not fit. The first step is the normal rendering. None means no budget.
+token_budget = int(os.environ["TOKEN_BUDGET"]) if os.environ.get("TOKEN_BUDGET") else None
+degrade_steps = [(200, "high"), (72, "high"), (72, "low")]
+expected_output_tokens = 600  # Per request, used by the estimate; observed completions are mostly below this
+
+_log_lock = threading.Lock()
+_hedge_executor = None
+_hedge_executor_pid = None
+_hedge_executor_workers = None
+_hedge_executor_lock = threading.Lock()
+# Cancelled hedged paths whose in-flight work has not finished, so their tokens are not reported yet
+_late_hedges = 0
+_late_hedges_done = threading.Condition()
+
+# Prompts for the image-based extraction, sent with every batch of pages
+vision_system_message = """You are an expert document editor analyzing PDF pages generated from Word documents with track changes.
+    Your task is to identify and extract only the paragraphs that have been modified with track changes. 
+    Focus exclusively on changes such as insertions, deletions, and replacements.
+    Do not extract paragraphs without modification."""
+
+vision_user_content = """Please identify paragraphs with tracked changes in these PDF pages.
+    - Only consider paragraphs that begin with a numerical prefix (e.g., "1.", "2.1", "3.a").
+    - For paragraphs, represent formatting changes as follows:
+        - Underlined text: <u>text</u>
+        - Strikethrough text: <s>text</s>
+        - Highlighted text: <highlight>text</highlight>
+    - Do not return the paragraphs that have no change.
+    
+    Return the output in JSON format with each element containing:
+    - 'paragraph_number': The paragraph number
+    - 'content': The paragraph content with tracked changes marked using the specified formatting tags
+    """
+
+# Prompts for the text-layer extraction; {text_content} is replaced with the PDF text
+text_system_message = """You are an expert document editor. You are given text extracted from a PDF file that was generated from a Word document with track changes enabled.
+    
+    Your task is to identify and extract only the paragraphs that have been modified or deleted by track changes. Please focus exclusively on changes such as insertions, deletions, and replacements. Do not extract paragraphs without modification."""
+
+text_user_content = """Please identify paragraphs with tracked changes in this PDF text.
+    - Only consider paragraphs that begin with a numerical prefix (e.g., "1.", "2.1", "3.a").
+    - For paragraphs, represent formatting changes as follows:
+        - Underlined text: <u>text</u>
+        - Strikethrough text: <s>text</s>
+        - Highlighted text: <highlight>text</highlight>
+    - Do not return the paragraphs that have no change.
+    
+    Return the output in JSON format with each element containing:
+    - 'paragraph_number': The paragraph number
+    - 'content': The paragraph content with tracked changes marked using the specified formatting tags
+    
+    Here is the text:
+    {text_content}
+    """
 
-# Azure OpenAI configuration
-endpoint = "https://openai-eus-ti-poc-shared-resources.openai.azure.com/"
-api_key = "f6f65288e4ec4f89a92387cb877c4b17"  # Replace with your actual API key
-deployment_id = "chat-gpt-4o"  # or "chat-gpt-4o-mini"
-api_version = "2025-01-01-preview"
 
 # We'll use requests directly instead of the OpenAI client
 
 
+class IncompleteExtraction(Exception):
+    """
+    Raised when some batches of pages still fail after retries. Carries the changes of the batches that
+    succeeded (which are checkpointed, so a resubmitted document only pays for the incomplete pages).
+    """
+
+    def __init__(self, changes, token_usage, incomplete_pages):
+        super().__init__(f"Extraction incomplete, pages {', '.join(incomplete_pages)} failed")
+        self.changes = changes
+        self.token_usage = token_usage
+        self.incomplete_pages = incomplete_pages
+
+
 def extract_text_from_pdf(pdf_path):
     """Extracts text directly from a PDF using pdfplumber."""
+    import pdfplumber
     try:
         with pdfplumber.open(pdf_path) as pdf:
             all_text = ""
@@ -39,6 +153,7 @@ def extract_text_from_pdf(pdf_path):
 
 def call_azure_openai(messages, deployment_id, api_key, endpoint, api_version):
     """Call Azure OpenAI API directly using requests."""
+    import requests
     url = f"{endpoint}openai/deployments/{deployment_id}/chat/completions?api-version={api_version}"
     headers = {
         "Content-Type": "application/json",
@@ -62,15 +177,18 @@ def call_azure_openai(messages, deployment_id, api_key, endpoint, api_version):
         raise Exception(f"Azure OpenAI API error: {response.status_code}")
 
 
-def extract_changes_from_pdf(pdf_path, _, deployment_id, pdf_filename):
+def extract_changes_from_pdf(pdf_path, _, router, pdf_filename, cancel_event=None, dpi=200, detail="high",
+                             token_budget=None):
     """
     Extracts tracked changes from a PDF by converting it to images and using Azure OpenAI vision capabilities.
     This works better for PDFs that contain tracked changes which may not be properly extracted as text.
+    Setting `cancel_event` stops the extraction before the next batch is sent.
+    Raises IncompleteExtraction when some batches keep failing or `token_budget` is spent before they are sent.
     """
     try:
         print(f"Processing PDF: {pdf_filename}")
         # Convert PDF to images
-        images = convert_pdf_to_images(pdf_path)
+        images = convert_pdf_to_images(pdf_path, dpi)
         
         if not images:
             print(f"Failed to convert PDF to images: {pdf_filename}")
@@ -79,22 +197,28 @@ def extract_changes_from_pdf(pdf_path, _, deployment_id, pdf_filename):
         print(f"Successfully converted PDF to {len(images)} images")
         
         # Process images with Azure OpenAI
-        return process_images_with_azure_openai(images, deployment_id, pdf_filename)
+        # Checkpoints depend on how the pages were rendered as well as on the document
+        doc_hash = f"{document_hash(pdf_path)}-{dpi}dpi-{detail}"
+        return process_images_with_azure_openai(images, router, pdf_filename, cancel_event, doc_hash, detail,
+                                                token_budget)
         
+    except IncompleteExtraction:
+        raise
     except Exception as e:
         print(f"Error extracting changes from PDF: {e}")
         return [], 0
 
 
-def convert_pdf_to_images(pdf_path):
+def convert_pdf_to_images(pdf_path, dpi=200):
     """Converts PDF pages to images."""
+    from pdf2image import convert_from_path
     try:
         # For Windows, you may need to specify the path to poppler
         # Attempt to use the default path first
         try:
             images = convert_from_path(
                 pdf_path,
-                dpi=200,  # Adjust DPI for quality vs. performance
+                dpi=dpi,
                 fmt="png"
             )
         except Exception as poppler_error:
@@ -103,7 +227,7 @@ def convert_pdf_to_images(pdf_path):
             poppler_path = r"C:\Users\JD15806\Code\poppler-24.08.0\Library\bin"
             images = convert_from_path(
                 pdf_path,
-                dpi=200,
+                dpi=dpi,
                 fmt="png",
                 poppler_path=poppler_path
             )
@@ -115,28 +239,120 @@ def convert_pdf_to_images(pdf_path):
         return []
 
 
-def process_images_with_azure_openai(images, deployment_id, pdf_filename):
-    """Processes images with Azure OpenAI vision capabilities to extract tracked changes."""
-    extracted_changes = []
+def process_images_with_azure_openai(images, router, pdf_filename, cancel_event=None, doc_hash=None, detail="high",
+                                     token_budget=None):
+    """
+    Processes images with Azure OpenAI vision capabilities to extract tracked changes.
+    When `doc_hash` is given, batches already checkpointed for the document are reused and each
+    finished batch is checkpointed. Failed batches are retried up to `batch_retries` times;
+    if some still fail, IncompleteExtraction is raised with the changes of the other batches.
+    No batch or retry is sent once the tokens used reach `token_budget`; the pages left are incomplete too.
+    A batch already sent is not interrupted, so the usage can exceed the budget by one batch and its escalations.
+    """
     total_token_usage = 0
+    batch_ranges = [(i, min(i+batch_size, len(images))) for i in range(0, len(images), batch_size)]
     
-    # Process images in batches to avoid exceeding token limits
-    batch_size = 4  # Adjust based on token usage and performance
+    batch_results = {}
+    if doc_hash:
+        for start, end in batch_ranges:
+            checkpoint = load_batch_checkpoint(doc_hash, start, end)
+            if checkpoint is not None:
+                batch_results[(start, end)] = checkpoint
+        if batch_results:
+            print(f"Resuming {pdf_filename}: {len(batch_results)}/{len(batch_ranges)} batches already checkpointed")
     
-    for i in range(0, len(images), batch_size):
-        batch_images = images[i:i+batch_size]
-        batch_changes, batch_tokens = process_image_batch(batch_images, i, deployment_id)
-        
-        extracted_changes.extend(batch_changes)
-        total_token_usage += batch_tokens
+    pending = [r for r in batch_ranges if r not in batch_results]
+    for attempt in range(batch_retries + 1):
+        if not pending:
+            break
+        if attempt:
+            print(f"Retrying {len(pending)} failed batches (retry {attempt}/{batch_retries})")
+            time.sleep(batch_retry_delay * attempt)
         
-        print(f"Processed batch {i//batch_size + 1}/{(len(images) + batch_size - 1)//batch_size}, pages {i+1}-{min(i+batch_size, len(images))}")
+        failed = []
+        budget_spent = False
+        for index, (start, end) in enumerate(pending):
+            if cancel_event is not None and cancel_event.is_set():
+                print(f"Vision extraction cancelled before pages {start+1}-{end}: {pdf_filename}")
+                failed = []
+                pending = []
+                break
+            if token_budget is not None and total_token_usage >= token_budget:
+                print(f"Token budget of {token_budget} spent before pages {start+1}-{end}: {pdf_filename}")
+                failed.extend(pending[index:])
+                budget_spent = True
+                break
+            try:
+                batch_changes, batch_tokens = process_image_batch(images[start:end], start, router, detail)
+            except Exception as e:
+                print(f"Batch for pages {start+1}-{end} failed: {e}")
+                failed.append((start, end))
+                continue
+            
+            batch_results[(start, end)] = batch_changes
+            total_token_usage += batch_tokens
+            if doc_hash:
+                save_batch_checkpoint(doc_hash, start, end, batch_changes, batch_tokens)
+            
+            print(f"Processed batch {start//batch_size + 1}/{len(batch_ranges)}, pages {start+1}-{end}")
+        pending = failed
+        if budget_spent:
+            break
     
+    extracted_changes = []
+    for batch_range in batch_ranges:
+        extracted_changes.extend(batch_results.get(batch_range, []))
+    
+    if pending:
+        incomplete_pages = [f"{start+1}-{end}" for start, end in pending]
+        print(f"Batches not extracted, pages {', '.join(incomplete_pages)}: {pdf_filename}")
+        raise IncompleteExtraction(extracted_changes, total_token_usage, incomplete_pages)
     return extracted_changes, total_token_usage
 
 
-def process_image_batch(images, start_page, deployment_id):
-    """Process a batch of images with Azure OpenAI."""
+def document_hash(pdf_path):
+    """Returns the SHA-256 hash of a PDF file, used to key its batch checkpoints."""
+    sha256 = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def batch_checkpoint_path(doc_hash, start_page, end_page):
+    return os.path.join(checkpoint_dir, doc_hash, f'pages_{start_page+1}-{end_page}.json')
+
+
+def load_batch_checkpoint(doc_hash, start_page, end_page):
+    """Returns the checkpointed changes of a batch, or None if the batch has not finished before."""
+    path = batch_checkpoint_path(doc_hash, start_page, end_page)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)['changes']
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError) as e:
+        print(f"Ignoring unreadable checkpoint {path}: {e}")
+        return None
+
+
+def save_batch_checkpoint(doc_hash, start_page, end_page, changes, token_usage):
+    """Checkpoints the changes of a finished batch. Written atomically so an interrupted job never leaves a partial file."""
+    path = batch_checkpoint_path(doc_hash, start_page, end_page)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'pages': f"{start_page+1}-{end_page}",
+            'changes': changes,
+            'token_usage': token_usage,
+            'timestamp': datetime.now().isoformat()
+        }, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def process_image_batch(images, start_page, router, detail="high"):
+    """Process a batch of images with Azure OpenAI. Raises if no deployment returned valid output."""
     # Convert images to base64
     base64_images = []
     for img in images:
@@ -145,43 +361,93 @@ def process_image_batch(images, start_page, deployment_id):
         img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
         base64_images.append(img_base64)
     
-    # Prepare prompt
-    system_message = """You are an expert document editor analyzing PDF pages generated from Word documents with track changes.
-    Your task is to identify and extract only the paragraphs that have been modified with track changes. 
-    Focus exclusively on changes such as insertions, deletions, and replacements.
-    Do not extract paragraphs without modification."""
-    
-    user_content = """Please identify paragraphs with tracked changes in these PDF pages.
-    - Only consider paragraphs that begin with a numerical prefix (e.g., "1.", "2.1", "3.a").
-    - For paragraphs, represent formatting changes as follows:
-        - Underlined text: <u>text</u>
-        - Strikethrough text: <s>text</s>
-        - Highlighted text: <highlight>text</highlight>
-    - Do not return the paragraphs that have no change.
-    
-    Return the output in JSON format with each element containing:
-    - 'paragraph_number': The paragraph number
-    - 'content': The paragraph content with tracked changes marked using the specified formatting tags
-    """
-    
     # Create message content with images
     messages = [
-        {"role": "system", "content": system_message},
+        {"role": "system", "content": vision_system_message},
         {
             "role": "user", 
             "content": [
-                {"type": "text", "text": user_content}
-            ] + [{"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img}"}} for img in base64_images]
+                {"type": "text", "text": vision_user_content}
+            ] + [{"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img}", "detail": detail}} for img in base64_images]
         }
     ]
     
-    # Call Azure OpenAI API
-    url = f"{endpoint}openai/deployments/{deployment_id}/chat/completions?api-version={api_version}"
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": api_key
+    payload = {
+        "messages": messages,
+        "temperature": 0,
+        "top_p": 0.95,
+        "max_tokens": 4000,
+        "stream": False
     }
     
+    # Create output directory if it doesn't exist
+    output_dir = os.path.join(os.path.dirname(__file__), 'outputs')
+    os.makedirs(output_dir, exist_ok=True)
+
+    def validate(response_content):
+        # Save raw response for debugging
+        debug_file = os.path.join(output_dir, f'raw_response_batch_{start_page+1}.txt')
+        with open(debug_file, 'w', encoding='utf-8') as f:
+            f.write(response_content)
+        return parse_changes_response(response_content)
+
+    # Call Azure OpenAI API, escalating to a stronger deployment if the output is invalid
+    batch_changes, token_usage, used_deployment = router.complete(payload, validate)
+
+    # Add page numbers to changes
+    for change in batch_changes:
+        change['page'] = f"Pages {start_page+1}-{start_page+len(images)}"
+    
+    # Save processed changes
+    output_file = os.path.join(output_dir, f'changes_batch_{start_page+1}.json')
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(batch_changes, f, indent=2)
+    
+    print(f"Successfully processed batch {start_page+1} with {len(batch_changes)} changes using {used_deployment}")
+    return batch_changes, token_usage
+
+
+def parse_changes_response(response_content):
+    """
+    Parses the JSON list of changes returned by the model.
+    Raises ValueError when the output is not a list of paragraphs with 'paragraph_number' and 'content',
+    which makes the router escalate the request to a stronger deployment.
+    """
+    # Clean up response content
+    if response_content.startswith('```'):
+        # Extract content between triple backticks
+        content_start = response_content.find('[')
+        content_end = response_content.rfind(']') + 1
+        if content_start >= 0 and content_end > content_start:
+            response_content = response_content[content_start:content_end]
+
+    try:
+        changes = json.loads(response_content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Failed to parse JSON response: {e}")
+
+    if not isinstance(changes, list):
+        raise ValueError(f"Expected a JSON list of changes, got {type(changes).__name__}")
+    for change in changes:
+        if not isinstance(change, dict) or 'paragraph_number' not in change or 'content' not in change:
+            raise ValueError(f"Malformed change entry: {change!r}")
+    return changes
+
+
+def extract_changes_from_text(pdf_path, router, cancel_event=None):
+    """
+    Extracts tracked changes from the text layer of a PDF using Azure OpenAI.
+    Used as a fallback for, or a hedge against, the image-based extraction.
+    Setting `cancel_event` skips the Azure OpenAI call if the text layer is still being read.
+    """
+    text_content = extract_text_from_pdf(pdf_path)
+    
+    # Prepare messages for Azure OpenAI
+    messages = [
+        {"role": "system", "content": text_system_message},
+        {"role": "user", "content": text_user_content.format(text_content=text_content)}
+    ]
+    
     payload = {
         "messages": messages,
         "temperature": 0,
@@ -189,61 +455,248 @@ def process_image_batch(images, start_page, deployment_id):
         "max_tokens": 4000,
         "stream": False
     }
+
+    if cancel_event is not None and cancel_event.is_set():
+        print("Text-based extraction cancelled")
+        return [], 0
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            response_json = response.json()
-            response_content = response_json['choices'][0]['message']['content'].strip()
-            
-            # Create output directory if it doesn't exist
-            output_dir = os.path.join(os.path.dirname(__file__), 'outputs')
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # Save raw response for debugging
-            debug_file = os.path.join(output_dir, f'raw_response_batch_{start_page+1}.txt')
-            with open(debug_file, 'w', encoding='utf-8') as f:
-                f.write(response_content)
-            
-            try:
-                # Clean up response content
-                if response_content.startswith('```json'):
-                    # Extract content between triple backticks
-                    content_start = response_content.find('[')
-                    content_end = response_content.rfind(']') + 1
-                    if content_start >= 0 and content_end > content_start:
-                        response_content = response_content[content_start:content_end]
-                
-                # Parse the JSON response
-                batch_changes = json.loads(response_content)
-                
-                # Add page numbers to changes
-                for change in batch_changes:
-                    if isinstance(change, dict) and 'paragraph_number' in change:
-                        change['page'] = f"Pages {start_page+1}-{start_page+len(images)}"
-                
-                # Save processed changes
-                output_file = os.path.join(output_dir, f'changes_batch_{start_page+1}.json')
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    json.dump(batch_changes, f, indent=2)
-                
-                token_usage = response_json.get('usage', {}).get('total_tokens', 0)
-                print(f"Successfully processed batch {start_page+1} with {len(batch_changes)} changes")
-                return batch_changes, token_usage
-                
-            except json.JSONDecodeError as e:
-                print(f"Failed to parse JSON response: {e}")
-                print(f"Response content after cleaning: {response_content}")
-                return [], 0
-        else:
-            print(f"Error calling Azure OpenAI API: {response.status_code}, {response.text}")
-            return [], 0
+        # Call Azure OpenAI with text
+        text_changes, text_token_usage, _ = router.complete(payload, parse_changes_response)
+        print(f"Found {len(text_changes)} changes using text-based extraction")
+        return text_changes, text_token_usage
     except Exception as e:
-        print(f"Exception while calling Azure OpenAI API: {e}")
+        print(f"Text-based extraction failed: {e}")
         return [], 0
 
 
+def merge_changes(primary, secondary):
+    """Merges two lists of changes per paragraph, keeping the primary entry when both have the paragraph."""
+    seen = {str(change.get('paragraph_number', '')).strip() for change in primary}
+    merged = list(primary)
+    for change in secondary:
+        if str(change.get('paragraph_number', '')).strip() not in seen:
+            merged.append(change)
+    return merged
+
+
+def extract_changes(pdf_path, pdf_filename, router, policy="off", deadline=60, dpi=200, detail="high", vision=True,
+                    on_late_tokens=None, token_budget=None):
+    """
+    Extracts tracked changes with the vision pipeline and the text-layer extraction according to a hedge policy
+    (see `hedge_policy`). Returns (changes, token_usage), where token usage includes the work of both paths
+    finished by the time the result is chosen.
+    Work whose result is not needed is cancelled; a request already sent to Azure OpenAI still completes, and the
+    tokens it used are passed to `on_late_tokens` once it does (by default they are logged to api_log.csv).
+    With `vision` False only the text-layer extraction runs.
+    `token_budget` stops the vision path from sending more batches, and skips the text-layer fallback of policy
+    "off", once the tokens used reach it. See plan_extraction() for choosing a rendering that fits.
+    Raises IncompleteExtraction when vision batches keep failing (or the budget is spent) and the text-layer
+    extraction, which covers every page, does not find changes in their place.
+    """
+    if not vision:
+        print(f"Processing PDF with text-based extraction only: {pdf_filename}")
+        return extract_changes_from_text(pdf_path, router)
+
+    if policy == "off":
+        print(f"Processing PDF with image-based extraction: {pdf_filename}")
+        changes, total_token_usage, incomplete_pages = extract_vision_outcome(
+            pdf_path, None, router, pdf_filename, None, dpi, detail, token_budget)
+        if not changes and token_budget is not None and total_token_usage >= token_budget:
+            print(f"Token budget of {token_budget} spent, skipping fallback text extraction")
+        elif not changes:
+            print("No changes detected with image-based extraction, trying fallback text extraction")
+            # If image-based extraction fails or finds no changes, try fallback with direct text extraction
+            text_changes, text_token_usage = extract_changes_from_text(pdf_path, router)
+            total_token_usage += text_token_usage
+            if text_changes:
+                return text_changes, total_token_usage
+        if incomplete_pages:
+            raise IncompleteExtraction(changes, total_token_usage, incomplete_pages)
+        return changes, total_token_usage
+
+    if policy not in hedge_policies:
+        raise ValueError(f"Unknown hedge policy: {policy}")
+
+    print(f"Processing PDF with hedged extraction ({policy}): {pdf_filename}")
+    cancel_vision = threading.Event()
+    cancel_text = threading.Event()
+    executor = hedge_executor()
+    vision_started = threading.Event()
+
+    def run_vision():
+        vision_started.set()
+        return extract_vision_outcome(pdf_path, None, router, pdf_filename, cancel_vision, dpi, detail, token_budget)
+
+    vision = executor.submit(run_vision)
+    text = executor.submit(extract_changes_from_text, pdf_path, router, cancel_text)
+
+    def tokens_spent(*futures):
+        # Paths still running report their tokens when they finish
+        spent = 0
+        for future in futures:
+            if future.done():
+                spent += future.result()[1]
+            else:
+                report_late_tokens(future, pdf_filename, on_late_tokens)
+        return spent
+
+    def valid(future):
+        # A vision result with incomplete pages only counts if the text path finds nothing either
+        changes = future.result()[0]
+        return bool(changes) and not (future is vision and vision.result()[2])
+
+    def vision_result():
+        changes, _, incomplete_pages = vision.result()
+        tokens = tokens_spent(vision, text)
+        if incomplete_pages:
+            raise IncompleteExtraction(changes, tokens, incomplete_pages)
+        return changes, tokens
+
+    if policy == "merge":
+        vision_changes, _, incomplete_pages = vision.result()
+        text_changes, _ = text.result()
+        if incomplete_pages and not text_changes:
+            return vision_result()
+        return merge_changes(vision_changes, text_changes), tokens_spent(vision, text)
+
+    if policy == "deadline":
+        # The deadline starts when the vision path gets a thread, not while it is queued behind other documents
+        vision_started.wait()
+        done, _ = wait([vision], timeout=deadline)
+        if done and valid(vision):
+            cancel_text.set()
+            return vision.result()[0], tokens_spent(vision, text)
+        print(f"No vision changes within {deadline}s, using text-based extraction")
+        if text.result()[0]:
+            cancel_vision.set()
+            return text.result()[0], tokens_spent(vision, text)
+        return vision_result()
+
+    # "first": take whichever path returns changes first
+    pending = {vision, text}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future, loser_cancel in ((vision, cancel_text), (text, cancel_vision)):
+            if future in done and valid(future):
+                loser_cancel.set()
+                return future.result()[0], tokens_spent(vision, text)
+    return vision_result()
+
+
+def extract_vision_outcome(*args):
+    """
+    Runs extract_changes_from_pdf with the same arguments and returns (changes, token_usage, incomplete_pages),
+    with the partial result of an IncompleteExtraction instead of the exception.
+    """
+    try:
+        changes, token_usage = extract_changes_from_pdf(*args)
+        return changes, token_usage, []
+    except IncompleteExtraction as e:
+        return e.changes, e.token_usage, e.incomplete_pages
+
+
+def report_late_tokens(future, pdf_filename, on_late_tokens=None):
+    """Reports the tokens of a cancelled hedged path once its in-flight work finishes. See wait_for_hedged_work()."""
+    global _late_hedges
+    with _late_hedges_done:
+        _late_hedges += 1
+
+    def report(future):
+        global _late_hedges
+        try:
+            tokens = future.result()[1]
+            if tokens:
+                print(f"Cancelled hedged extraction of {pdf_filename} used {tokens} tokens")
+                if on_late_tokens is not None:
+                    on_late_tokens(tokens)
+                else:
+                    log_api_call(pdf_filename, "", "Azure OpenAI API: cancelled hedged extraction", tokens)
+        except Exception as e:
+            print(f"Failed to report tokens of cancelled hedged extraction: {e}")
+        finally:
+            with _late_hedges_done:
+                _late_hedges -= 1
+                _late_hedges_done.notify_all()
+
+    future.add_done_callback(report)
+
+
+def wait_for_hedged_work(timeout=None):
+    """Blocks until the tokens of every cancelled hedged path have been reported. Returns False on timeout."""
+    with _late_hedges_done:
+        return _late_hedges_done.wait_for(lambda: _late_hedges == 0, timeout)
+
+
+def hedge_executor():
+    """
+    Returns the thread pool shared by hedged extractions, created once per process and again after a fork.
+    Each hedged document uses two threads, so `hedge_workers` should be at least twice the number of documents
+    processed at once; the pool is replaced when it is changed.
+    """
+    global _hedge_executor, _hedge_executor_pid, _hedge_executor_workers
+    with _hedge_executor_lock:
+        if _hedge_executor is None or _hedge_executor_pid != os.getpid() or _hedge_executor_workers != hedge_workers:
+            if _hedge_executor is not None and _hedge_executor_pid == os.getpid():
+                _hedge_executor.shutdown(wait=False)  # Work already submitted still finishes
+            _hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="hedge")
+            _hedge_executor_pid = os.getpid()
+            _hedge_executor_workers = hedge_workers
+        return _hedge_executor
+
+
+def estimate_tokens(pdf_path):
+    """
+    Pre-flight estimate of the tokens each extraction option would use, computed from the page sizes
+    and text layer of the PDF without rendering it or calling Azure OpenAI.
+    Returns the vision estimate for every step of `degrade_steps` and the text-layer estimate.
+    """
+    page_sizes, text_length = token_estimator.read_pdf_layout(pdf_path)
+    vision_prompt = vision_system_message + vision_user_content
+    text_prompt = text_system_message + text_user_content
+    return {
+        "vision": [
+            token_estimator.estimate_vision(page_sizes, dpi, detail, batch_size, vision_prompt, expected_output_tokens)
+            for dpi, detail in degrade_steps
+        ],
+        "text": token_estimator.estimate_text(text_length, text_prompt, expected_output_tokens),
+    }
+
+
+def plan_extraction(estimate, budget):
+    """
+    Chooses how to extract a document within a token budget: the first rendering step whose estimate fits,
+    otherwise text-layer extraction only. Returns None when nothing fits.
+    The vision estimate includes the text-layer extraction: hedged policies run both paths, and with policy "off"
+    the text-layer fallback runs when the vision pass finds nothing. Retries and escalations to stronger
+    deployments are not estimated; extract_changes() stops sending batches once the budget is spent.
+    """
+    text_tokens = estimate["text"]["total_tokens"]
+    for vision_estimate in estimate["vision"]:
+        tokens = vision_estimate["total_tokens"] + text_tokens
+        if budget is None or tokens <= budget:
+            return {"mode": "vision", "dpi": vision_estimate["dpi"], "detail": vision_estimate["detail"],
+                    "estimated_tokens": tokens}
+    if text_tokens <= budget:
+        return {"mode": "text", "dpi": None, "detail": None, "estimated_tokens": text_tokens}
+    return None
+
+
+def parse_token_budget(form, default=None):
+    """Reads the optional "token_budget" form field. Raises ValueError if it is not a positive integer."""
+    value = form.get("token_budget")
+    if value in (None, ""):
+        return default
+    return validate_token_budget(int(value))
+
+
+def validate_token_budget(budget, name="token_budget"):
+    """Returns the budget, which may be None for no budget. Raises ValueError if it is not positive."""
+    if budget is not None and budget <= 0:
+        raise ValueError(f"{name} must be positive")
+    return budget
+
+
 def add_formatted_text(paragraph, text):
     """Adds text to a paragraph, applying formatting markers."""
     if text == "":
@@ -276,6 +729,7 @@ def fill_word_template(template_path, changes):
     """Fills a Word template with extracted changes.
        Replaces {{txtNo}} with paragraph_number and {{txtParagraph}} with content.
     """
+    from docx import Document
     doc = Document(template_path)
 
      # Find the target table
@@ -336,8 +790,25 @@ def fill_word_template(template_path, changes):
     return doc
 
 
+def save_word_document(template_path, changes, pdf_filename, result_dir):
+    """Fills the Word template with the changes and saves it to result_dir. Returns (word_filename, result_path)."""
+    output_doc = fill_word_template(template_path, changes)
+
+    # Create result directory if it doesn't exist
+    os.makedirs(result_dir, exist_ok=True)
+
+    # Generate unique filename with timestamp
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    word_filename = f"output_{os.path.splitext(pdf_filename)[0]}_{timestamp}.docx"
+    result_path = os.path.join(result_dir, word_filename)
+    
+    # Save file to result directory
+    output_doc.save(result_path)
+    return word_filename, result_path
+
+
 def log_api_call(pdf_filename, word_filename, api_info, token_usage=None):
-    """Logs API call information to a CSV file."""
+    """Logs API call information to a CSV file. Safe to call from several threads."""
     log_data = {
         "timestamp": datetime.now().isoformat(),
         "pdf_filename": pdf_filename,
@@ -345,7 +816,7 @@ def log_api_call(pdf_filename, word_filename, api_info, token_usage=None):
         "api_info": api_info,
         "token_usage": token_usage,
     }
-    with open("api_log.csv", "a", newline="", encoding="utf-8") as csvfile:
+    with _log_lock, open("api_log.csv", "a", newline="", encoding="utf-8") as csvfile:
         fieldnames = ["timestamp", "pdf_filename", "word_filename", "api_info", "token_usage"]
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         if csvfile.tell() == 0:
@@ -353,8 +824,47 @@ def log_api_call(pdf_filename, word_filename, api_info, token_usage=None):
         writer.writerow(log_data)
 
 
-@app.route("/")
-@app.route("/convert", methods=["POST"])
+@bp.route("/estimate", methods=["POST"])
+def estimate_pdf_tokens():
+    """Dry-run endpoint: estimates the token usage of converting a PDF, and the plan under an optional token budget."""
+    if "file" not in request.files:
+        return Response("Please provide a PDF file.", status=400)
+
+    pdf_file = request.files["file"]
+    if not pdf_file.filename.endswith(".pdf"):
+        return Response("Invalid file type. Please provide a PDF file.", status=400)
+
+    try:
+        budget = parse_token_budget(request.form, current_app.config["TOKEN_BUDGET"])
+    except ValueError:
+        return Response("Invalid token_budget. Please provide a positive integer.", status=400)
+
+    temp_dir = tempfile.mkdtemp()
+    pdf_path = os.path.join(temp_dir, "estimate.pdf")
+    try:
+        pdf_file.save(pdf_path)
+        estimate = estimate_tokens(pdf_path)
+        response_data = {
+            "pdf_filename": pdf_file.filename,
+            "token_budget": budget,
+            "plan": plan_extraction(estimate, budget),
+            "estimate": estimate
+        }
+        return Response(json.dumps(response_data), mimetype='application/json')
+    except Exception as e:
+        print(f"Error: {e}")
+        return Response(f"An error occurred: {e}", status=500)
+    finally:
+        try:
+            if os.path.exists(pdf_path):
+                os.remove(pdf_path)
+            os.rmdir(temp_dir)
+        except Exception as e:
+            print(f"Cleanup error: {e}")
+
+
+@bp.route("/")
+@bp.route("/convert", methods=["POST"])
 def convert_pdf_to_word():
     """API endpoint to convert a PDF with tracked changes to a Word document."""
     if "file" not in request.files or "template" not in request.files:
@@ -369,6 +879,14 @@ def convert_pdf_to_word():
     pdf_filename = pdf_file.filename
     template_filename = template_file.filename
 
+    policy = request.form.get("hedge", current_app.config["HEDGE_POLICY"])
+    if policy not in hedge_policies:
+        return Response(f"Invalid hedge policy. Use one of: {', '.join(hedge_policies)}.", status=400)
+    try:
+        budget = parse_token_budget(request.form, current_app.config["TOKEN_BUDGET"])
+    except ValueError:
+        return Response("Invalid token_budget. Please provide a positive integer.", status=400)
+
     # Create temporary directory for this request
     import tempfile
     temp_dir = tempfile.mkdtemp()
@@ -382,9 +900,20 @@ def convert_pdf_to_word():
     response = None
     
     try:
-        print(f"Processing PDF with image-based extraction: {pdf_filename}")
-        # Use the new image-based extraction method
-        changes, total_token_usage = extract_changes_from_pdf(pdf_path, None, deployment_id, pdf_filename)
+        router = current_app.extensions["deployment_router"]
+        dpi, detail = degrade_steps[0]
+        plan = None
+        if budget is not None:
+            plan = plan_extraction(estimate_tokens(pdf_path), budget)
+            if plan is None:
+                return Response(f"The estimated token usage of {pdf_filename} exceeds the token budget of {budget}.", status=413)
+            print(f"Extraction plan for {pdf_filename} within budget {budget}: {plan}")
+            dpi, detail = plan["dpi"], plan["detail"]
+
+        changes, total_token_usage = extract_changes(pdf_path, pdf_filename, router, policy,
+                                                     current_app.config["HEDGE_DEADLINE"], dpi, detail,
+                                                     vision=plan is None or plan["mode"] == "vision",
+                                                     token_budget=budget)
         
         # Save total changes for testing
         output_dir = os.path.join(os.path.dirname(__file__), 'outputs')
@@ -398,89 +927,14 @@ def convert_pdf_to_word():
                 'token_usage': total_token_usage
             }, f, indent=2)
 
-        if not changes:
-            print("No changes detected with image-based extraction, trying fallback text extraction")
-            # If image-based extraction fails or finds no changes, try fallback with direct text extraction
-            text_content = extract_text_from_pdf(pdf_path)
-            
-            # Prepare messages for Azure OpenAI
-            system_message = """You are an expert document editor. You are given text extracted from a PDF file that was generated from a Word document with track changes enabled.
-            
-            Your task is to identify and extract only the paragraphs that have been modified or deleted by track changes. Please focus exclusively on changes such as insertions, deletions, and replacements. Do not extract paragraphs without modification."""
-            
-            user_content = f"""Please identify paragraphs with tracked changes in this PDF text.
-            - Only consider paragraphs that begin with a numerical prefix (e.g., "1.", "2.1", "3.a").
-            - For paragraphs, represent formatting changes as follows:
-                - Underlined text: <u>text</u>
-                - Strikethrough text: <s>text</s>
-                - Highlighted text: <highlight>text</highlight>
-            - Do not return the paragraphs that have no change.
-            
-            Return the output in JSON format with each element containing:
-            - 'paragraph_number': The paragraph number
-            - 'content': The paragraph content with tracked changes marked using the specified formatting tags
-            
-            Here is the text:
-            {text_content}
-            """
-            
-            messages = [
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_content}
-            ]
-            
-            # Call Azure OpenAI with text
-            url = f"{endpoint}openai/deployments/{deployment_id}/chat/completions?api-version={api_version}"
-            headers = {
-                "Content-Type": "application/json",
-                "api-key": api_key
-            }
-            
-            payload = {
-                "messages": messages,
-                "temperature": 0,
-                "top_p": 0.95,
-                "max_tokens": 4000,
-                "stream": False
-            }
-            
-            text_response = requests.post(url, headers=headers, json=payload)
-            
-            if text_response.status_code == 200:
-                text_response_json = text_response.json()
-                text_content_response = text_response_json['choices'][0]['message']['content'].strip()
-                
-                try:
-                    # Try to parse the JSON response
-                    text_changes = json.loads(text_content_response)
-                    
-                    # Use these changes if we found some
-                    if text_changes:
-                        changes = text_changes
-                        total_token_usage = text_response_json.get('usage', {}).get('total_tokens', 0)
-                        print(f"Found {len(changes)} changes using text-based extraction")
-                except json.JSONDecodeError as e:
-                    print(f"Failed to parse JSON response from text-based extraction: {e}")
-
         if not changes:
             return Response("No changes detected in the PDF document.", status=400)
 
         print(f"Processing {len(changes)} extracted changes")
-        output_doc = fill_word_template(template_path, changes)
-
-        # Create result directory if it doesn't exist
         result_dir = os.path.join(os.path.dirname(__file__), 'result')
-        os.makedirs(result_dir, exist_ok=True)
-
-        # Generate unique filename with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        word_filename = f"output_{os.path.splitext(pdf_filename)[0]}_{timestamp}.docx"
-        result_path = os.path.join(result_dir, word_filename)
-        
-        # Save file to result directory
-        output_doc.save(result_path)
+        word_filename, result_path = save_word_document(template_path, changes, pdf_filename, result_dir)
 
-        log_api_call(pdf_filename, word_filename, f"Azure OpenAI API: {deployment_id}", total_token_usage)
+        log_api_call(pdf_filename, word_filename, f"Azure OpenAI API: {router.describe()}", total_token_usage)
 
         # Return JSON response with filename and token usage
         response_data = {
@@ -488,9 +942,22 @@ def convert_pdf_to_word():
             "token_usage": total_token_usage,
             "file_path": result_path
         }
+        if plan is not None:
+            response_data["extraction_plan"] = plan
         
         return Response(json.dumps(response_data), mimetype='application/json')
 
+    except IncompleteExtraction as e:
+        # Finished batches are checkpointed: resubmitting the document only pays for the incomplete pages
+        print(f"Error: {e}")
+        log_api_call(pdf_filename, "", f"Azure OpenAI API: {router.describe()} (incomplete)", e.token_usage)
+        response_data = {
+            "error": f"{e}. Please resubmit the document to retry the incomplete pages.",
+            "incomplete_pages": e.incomplete_pages,
+            "token_usage": e.token_usage
+        }
+        return Response(json.dumps(response_data), status=502, mimetype='application/json')
+
     except Exception as e:
         print(f"Error: {e}")
         return Response(f"An error occurred: {e}", status=500)
@@ -512,9 +979,64 @@ def convert_pdf_to_word():
             # Continue even if cleanup fails
 
 
+def import_heavy_modules():
+    """
+    Imports the modules that are otherwise loaded on first use. Called in the gunicorn master when the app
+    is preloaded, so forked workers share them instead of each importing them on their first request.
+    """
+    import docx  # noqa: F401
+    import pdf2image  # noqa: F401
+    import pdfplumber  # noqa: F401
+    import pypdfium2  # noqa: F401
+    import requests  # noqa: F401
+
+
+def create_app(config=None):
+    """
+    Application factory. Configuration defaults to the module settings, which are read from the environment,
+    and can be overridden with `config`. The deployment router, and with it the HTTP session, belongs to the app.
+    The hedge thread pool and the batch checkpoints are shared by the whole process, so CHECKPOINT_DIR and
+    HEDGE_WORKERS are applied to the module settings.
+    """
+    global checkpoint_dir, hedge_workers
+    app = Flask(__name__)
+    app.config.update(
+        AZURE_OPENAI_ENDPOINT=endpoint,
+        AZURE_OPENAI_API_KEY=api_key,
+        AZURE_OPENAI_API_VERSION=api_version,
+        AZURE_OPENAI_DEPLOYMENT=deployment_id,
+        AZURE_OPENAI_DEPLOYMENT_TIERS=custom_deployment_tiers,
+        HEDGE_POLICY=hedge_policy,
+        HEDGE_DEADLINE=hedge_deadline,
+        TOKEN_BUDGET=token_budget,
+        CHECKPOINT_DIR=checkpoint_dir,
+        HEDGE_WORKERS=hedge_workers,
+    )
+    if config:
+        app.config.update(config)
+
+    if not app.config["AZURE_OPENAI_API_KEY"]:
+        raise ValueError("AZURE_OPENAI_API_KEY is not set")
+    if app.config["HEDGE_POLICY"] not in hedge_policies:
+        raise ValueError(f"Unknown hedge policy: {app.config['HEDGE_POLICY']}")
+    validate_token_budget(app.config["TOKEN_BUDGET"], "TOKEN_BUDGET")
+    checkpoint_dir = app.config["CHECKPOINT_DIR"]
+    hedge_workers = app.config["HEDGE_WORKERS"]  # The pool is replaced on its next use if this changed
+
+    app.extensions["deployment_router"] = DeploymentRouter(
+        build_deployment_tiers(app.config["AZURE_OPENAI_DEPLOYMENT_TIERS"], app.config["AZURE_OPENAI_DEPLOYMENT"]),
+        app.config["AZURE_OPENAI_ENDPOINT"],
+        app.config["AZURE_OPENAI_API_KEY"],
+        app.config["AZURE_OPENAI_API_VERSION"],
+    )
+    app.register_blueprint(bp)
+    return app
+
+
 if __name__ == "__main__":
     if not os.path.exists("api_log.csv"):
         with open("api_log.csv", "w", newline="", encoding="utf-8") as f:
             writer = csv.writer(f)
             writer.writerow(["timestamp", "pdf_filename", "word_filename", "api_info", "token_usage"])
-    app.run(debug=True, host="0.0.0.0", port=5000)
\ No newline at end of file
+    # The debugger allows running code from the browser, so it is only enabled with FLASK_DEBUG=1
+    create_app().run(debug=os.environ.get("FLASK_DEBUG", "0") == "1", host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
\ No newline at end of file
@@ -77,7 +77,7 @@ def test_azure_openai_vision(image_path=None):
     """Test Azure OpenAI's vision capabilities with an image."""
     # Azure OpenAI configuration
     endpoint = "https://openai-eus-ti-poc-shared-resources.openai.azure.com/"
-    api_key = "f6f65288e4ec4f89a92387cb877c4b17"
+    api_key = os.environ.get("AZURE_OPENAI_API_KEY")
     deployment_id = "chat-gpt-4o"
     api_version = "2025-01-01-preview"
     
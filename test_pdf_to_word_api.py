@@ -0,0 +1,559 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import wait
+
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "test-key")  # Read when pdf_to_word_api is imported
+
+from deployment_router import DeploymentRouter, RequestRejected
+import batch_convert
+import pdf_to_word_api
+from pdf_to_word_api import parse_changes_response, extract_changes, merge_changes, process_images_with_azure_openai
+from pdf_to_word_api import estimate_tokens, plan_extraction
+import token_estimator
+
+
+def mock_response(content, status_code=200, total_tokens=100, headers=None):
+    """Builds a fake Azure OpenAI chat completion response."""
+    response = MagicMock()
+    response.status_code = status_code
+    response.text = content
+    response.headers = headers or {}
+    response.json.return_value = {
+        "choices": [{"message": {"content": content}}],
+        "usage": {"total_tokens": total_tokens}
+    }
+    return response
+
+
+VALID_CHANGES = json.dumps([{"paragraph_number": "1.", "content": "<u>new</u> text"}])
+
+
+class TestDeploymentRouter(unittest.TestCase):
+
+    def make_router(self, tiers):
+        return DeploymentRouter(tiers, "https://example.openai.azure.com/", "key", "2025-01-01-preview")
+
+    @patch('requests.Session.post')
+    def test_cheap_tier_used_when_output_valid(self, mock_post):
+        mock_post.return_value = mock_response(VALID_CHANGES)
+        router = self.make_router([[{"deployment_id": "mini"}], [{"deployment_id": "large"}]])
+
+        changes, tokens, used = router.complete({}, parse_changes_response)
+
+        self.assertEqual(used, "mini")
+        self.assertEqual(tokens, 100)
+        self.assertEqual(changes[0]["paragraph_number"], "1.")
+        mock_post.assert_called_once()
+
+    @patch('requests.Session.post')
+    def test_escalates_when_output_invalid(self, mock_post):
+        mock_post.side_effect = [mock_response("not json"), mock_response(VALID_CHANGES, total_tokens=300)]
+        router = self.make_router([[{"deployment_id": "mini"}], [{"deployment_id": "large"}]])
+
+        changes, tokens, used = router.complete({}, parse_changes_response)
+
+        self.assertEqual(used, "large")
+        self.assertEqual(tokens, 400)
+        self.assertIn("/deployments/large/", mock_post.call_args[0][0])
+
+    @patch('requests.Session.post')
+    def test_fails_over_within_tier_on_error(self, mock_post):
+        def post(url, **kwargs):
+            if url.startswith("https://east."):
+                return mock_response("throttled", status_code=429, headers={"retry-after": "5"})
+            return mock_response(VALID_CHANGES)
+        mock_post.side_effect = post
+        router = self.make_router([[
+            {"deployment_id": "a", "endpoint": "https://east.openai.azure.com/"},
+            {"deployment_id": "b", "endpoint": "https://west.openai.azure.com/"},
+        ]])
+        east = router.tiers[0][0]
+        east.latency = 0.001  # Make sure the throttled deployment is very likely to be tried first
+
+        for _ in range(5):
+            _, _, used = router.complete({}, parse_changes_response)
+            self.assertEqual(used, "b")
+        # The throttled deployment is on cooldown, skipped and only called once
+        self.assertEqual([d.deployment_id for d in router.candidates(router.tiers[0])], ["b"])
+        self.assertEqual([d.deployment_id for d in router.cooling_down(router.tiers[0])], ["a"])
+        self.assertLessEqual(sum(call[0][0].startswith("https://east.") for call in mock_post.call_args_list), 1)
+
+    @patch('requests.Session.post')
+    def test_malformed_or_filtered_response_escalates(self, mock_post):
+        filtered = mock_response("")
+        filtered.json.return_value = {"choices": [{"message": {"content": None}, "finish_reason": "content_filter"}],
+                                      "usage": {"total_tokens": 20}}
+        empty = mock_response("")
+        empty.json.return_value = {"choices": []}
+        mock_post.side_effect = [filtered, empty, mock_response(VALID_CHANGES)]
+        router = self.make_router([[{"deployment_id": "mini"}], [{"deployment_id": "mid"}], [{"deployment_id": "large"}]])
+
+        _, tokens, used = router.complete({}, parse_changes_response)
+
+        self.assertEqual(used, "large")
+        self.assertEqual(tokens, 120)
+
+    def test_load_is_spread_by_latency_and_quota(self):
+        router = self.make_router([[{"deployment_id": "slow"}, {"deployment_id": "fast"}, {"deployment_id": "empty"}]])
+        router._random.seed(0)
+        slow, fast, empty = router.tiers[0]
+        slow.latency, fast.latency, empty.latency = 3.0, 1.0, 0.5
+        slow.remaining_tokens = fast.remaining_tokens = 10000
+        empty.remaining_tokens = 0
+        slow.quota_observed_at = fast.quota_observed_at = empty.quota_observed_at = time.monotonic()
+
+        first_choices = [router.candidates(router.tiers[0])[0].deployment_id for _ in range(1000)]
+
+        # Out of quota is never tried first; the others share the load roughly 1:3 by latency
+        self.assertNotIn("empty", first_choices)
+        self.assertGreater(first_choices.count("slow"), 150)
+        self.assertGreater(first_choices.count("fast"), 650)
+        self.assertEqual(router.candidates(router.tiers[0])[-1].deployment_id, "empty")
+
+        # Less remaining quota and requests in flight shift load away from a deployment
+        fast.remaining_tokens = 1000
+        fast.outstanding = 2
+        first_choices = [router.candidates(router.tiers[0])[0].deployment_id for _ in range(1000)]
+        self.assertGreater(first_choices.count("slow"), first_choices.count("fast"))
+
+    def test_quota_is_forgotten_when_rate_limit_window_resets(self):
+        router = self.make_router([[{"deployment_id": "a"}, {"deployment_id": "b"}]])
+        router._random.seed(0)
+        a, b = router.tiers[0]
+        a.remaining_tokens = 0
+        a.quota_observed_at = time.monotonic() - router.quota_max_age - 1
+
+        first_choices = [router.candidates(router.tiers[0])[0].deployment_id for _ in range(1000)]
+
+        self.assertGreater(first_choices.count("a"), 350)
+        self.assertIsNone(a.remaining_tokens)
+
+    @patch('requests.Session.post')
+    def test_tier_cooling_down_is_skipped_until_last_resort(self, mock_post):
+        def post(url, **kwargs):
+            if "/deployments/mini/" in url:
+                return mock_response("throttled", status_code=429, headers={"retry-after": "3600"})
+            return mock_response(VALID_CHANGES)
+        mock_post.side_effect = post
+        router = self.make_router([[{"deployment_id": "mini"}], [{"deployment_id": "large"}]])
+
+        for _ in range(3):
+            _, _, used = router.complete({}, parse_changes_response)
+            self.assertEqual(used, "large")
+        self.assertEqual(sum("/deployments/mini/" in call[0][0] for call in mock_post.call_args_list), 1)
+        # retry-after is honoured up to max_cooldown
+        self.assertLessEqual(router.tiers[0][0].cooldown_until, time.monotonic() + router.max_cooldown)
+
+        # With every tier cooling down, the deployments are still tried rather than failing outright
+        router.tiers[1][0].cooldown_until = time.monotonic() + 60
+        _, _, used = router.complete({}, parse_changes_response)
+        self.assertEqual(used, "large")
+
+    @patch('requests.Session.post')
+    def test_rejected_request_fails_fast_without_cooldown(self, mock_post):
+        mock_post.return_value = mock_response("context_length_exceeded", status_code=400)
+        router = self.make_router([[{"deployment_id": "a"}, {"deployment_id": "b"}], [{"deployment_id": "large"}]])
+
+        with self.assertRaises(RequestRejected):
+            router.complete({}, parse_changes_response)
+
+        mock_post.assert_called_once()
+        self.assertEqual(sum(len(router.cooling_down(tier)) for tier in router.tiers), 0)
+
+
+class TestParseChangesResponse(unittest.TestCase):
+
+    def test_strips_code_fence(self):
+        changes = parse_changes_response(f"```json\n{VALID_CHANGES}\n```")
+        self.assertEqual(len(changes), 1)
+
+    def test_rejects_malformed_entries(self):
+        with self.assertRaises(ValueError):
+            parse_changes_response(json.dumps([{"content": "missing number"}]))
+        with self.assertRaises(ValueError):
+            parse_changes_response(json.dumps({"paragraph_number": "1.", "content": "not a list"}))
+
+
+VISION_CHANGES = [{"paragraph_number": "1.", "content": "vision"}]
+TEXT_CHANGES = [{"paragraph_number": "1.", "content": "text"}, {"paragraph_number": "2.", "content": "text"}]
+
+
+def slow(result, seconds):
+    """Returns a fake extraction path that takes `seconds` and records whether it was cancelled."""
+    def run(*args):
+        cancel_event = next(arg for arg in args if isinstance(arg, threading.Event))
+        time.sleep(seconds)
+        return ([], 0) if cancel_event.is_set() else result
+    return run
+
+
+class TestHedgedExtraction(unittest.TestCase):
+
+    def run_policy(self, policy, vision, text, deadline=60):
+        with patch('pdf_to_word_api.extract_changes_from_pdf', side_effect=vision), \
+                patch('pdf_to_word_api.extract_changes_from_text', side_effect=text):
+            return extract_changes("doc.pdf", "doc.pdf", MagicMock(), policy, deadline)
+
+    def test_off_runs_text_only_when_vision_finds_nothing(self):
+        text = MagicMock(return_value=(TEXT_CHANGES, 50))
+        changes, tokens = self.run_policy("off", lambda *args: (VISION_CHANGES, 100), text)
+        self.assertEqual(changes, VISION_CHANGES)
+        text.assert_not_called()
+
+        changes, tokens = self.run_policy("off", lambda *args: ([], 100), lambda *args: (TEXT_CHANGES, 50))
+        self.assertEqual(changes, TEXT_CHANGES)
+        self.assertEqual(tokens, 150)
+
+    def test_first_takes_fastest_result(self):
+        changes, _ = self.run_policy("first", slow((VISION_CHANGES, 100), 0.5), slow((TEXT_CHANGES, 50), 0.0))
+        self.assertEqual(changes, TEXT_CHANGES)
+
+    def test_deadline_falls_back_to_text(self):
+        changes, _ = self.run_policy("deadline", slow((VISION_CHANGES, 100), 0.5), slow((TEXT_CHANGES, 50), 0.0),
+                                     deadline=0.1)
+        self.assertEqual(changes, TEXT_CHANGES)
+
+        changes, tokens = self.run_policy("deadline", slow((VISION_CHANGES, 100), 0.0), slow((TEXT_CHANGES, 50), 0.0))
+        self.assertEqual(changes, VISION_CHANGES)
+
+    def test_deadline_starts_when_vision_gets_a_thread(self):
+        with patch.object(pdf_to_word_api, 'hedge_workers', 2):
+            # Other documents occupy the pool, so the vision path queues for longer than the deadline
+            blockers = [pdf_to_word_api.hedge_executor().submit(time.sleep, 0.3) for _ in range(2)]
+            changes, _ = self.run_policy("deadline", slow((VISION_CHANGES, 100), 0.05), slow((TEXT_CHANGES, 50), 0.0),
+                                         deadline=0.2)
+            wait(blockers)
+        self.assertEqual(changes, VISION_CHANGES)
+
+    def test_cancelled_path_reports_tokens_of_in_flight_work(self):
+        def in_flight_vision(*args):
+            time.sleep(0.3)
+            return [], 1000  # The request was already sent when the path was cancelled
+
+        late_tokens = []
+        with patch('pdf_to_word_api.extract_changes_from_pdf', side_effect=in_flight_vision), \
+                patch('pdf_to_word_api.extract_changes_from_text', side_effect=slow((TEXT_CHANGES, 50), 0.0)):
+            changes, tokens = extract_changes("doc.pdf", "doc.pdf", MagicMock(), "first", 60,
+                                              on_late_tokens=late_tokens.append)
+            self.assertEqual((changes, tokens), (TEXT_CHANGES, 50))
+            self.assertTrue(pdf_to_word_api.wait_for_hedged_work(timeout=5))
+
+        self.assertEqual(late_tokens, [1000])
+
+    def test_merge_prefers_vision_per_paragraph(self):
+        changes, tokens = self.run_policy("merge", lambda *args: (VISION_CHANGES, 100), lambda *args: (TEXT_CHANGES, 50))
+        self.assertEqual([c["content"] for c in changes], ["vision", "text"])
+        self.assertEqual(tokens, 150)
+        self.assertEqual(merge_changes([], TEXT_CHANGES), TEXT_CHANGES)
+
+
+class TestBatchCheckpointing(unittest.TestCase):
+
+    def setUp(self):
+        self.checkpoint_dir = tempfile.TemporaryDirectory()
+        patcher = patch.multiple(pdf_to_word_api, checkpoint_dir=self.checkpoint_dir.name, batch_retry_delay=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.checkpoint_dir.cleanup)
+
+    def test_retries_only_failed_batches_and_resumes_from_checkpoints(self):
+        images = list(range(10))  # Three batches: pages 1-4, 5-8 and 9-10
+        calls = []
+
+        def flaky_batch(batch_images, start_page, router, detail):
+            calls.append(start_page)
+            if start_page == 4 and calls.count(4) == 1:
+                raise Exception("Azure OpenAI API error: 500")
+            return [{"paragraph_number": str(start_page), "content": "changed"}], 10
+
+        with patch('pdf_to_word_api.process_image_batch', side_effect=flaky_batch):
+            changes, tokens = process_images_with_azure_openai(images, MagicMock(), "doc.pdf", doc_hash="abc")
+
+        self.assertEqual(calls, [0, 4, 8, 4])
+        self.assertEqual([c["paragraph_number"] for c in changes], ["0", "4", "8"])
+        self.assertEqual(tokens, 30)
+
+        # A resubmitted document is served from the checkpoints without calling Azure OpenAI
+        with patch('pdf_to_word_api.process_image_batch') as mock_batch:
+            changes, tokens = process_images_with_azure_openai(images, MagicMock(), "doc.pdf", doc_hash="abc")
+        mock_batch.assert_not_called()
+        self.assertEqual([c["paragraph_number"] for c in changes], ["0", "4", "8"])
+        self.assertEqual(tokens, 0)
+
+    def test_reports_incomplete_pages_when_batch_keeps_failing(self):
+        def failing_last_batch(batch_images, start_page, router, detail):
+            if start_page == 4:
+                raise Exception("Azure OpenAI API error: 500")
+            return [{"paragraph_number": str(start_page), "content": "changed"}], 10
+
+        with patch('pdf_to_word_api.process_image_batch', side_effect=failing_last_batch) as mock_batch:
+            with self.assertRaises(pdf_to_word_api.IncompleteExtraction) as raised:
+                process_images_with_azure_openai(list(range(6)), MagicMock(), "doc.pdf", doc_hash="def")
+
+        self.assertEqual([c["paragraph_number"] for c in raised.exception.changes], ["0"])
+        self.assertEqual(raised.exception.incomplete_pages, ["5-6"])
+        self.assertEqual(raised.exception.token_usage, 10)
+        self.assertEqual(mock_batch.call_count, 1 + 1 + pdf_to_word_api.batch_retries)
+
+    def test_stops_sending_batches_when_token_budget_is_spent(self):
+        def batch(batch_images, start_page, router, detail):
+            return [{"paragraph_number": str(start_page), "content": "changed"}], 10
+
+        with patch('pdf_to_word_api.process_image_batch', side_effect=batch) as mock_batch:
+            with self.assertRaises(pdf_to_word_api.IncompleteExtraction) as raised:
+                process_images_with_azure_openai(list(range(12)), MagicMock(), "doc.pdf", token_budget=15)
+
+        self.assertEqual(mock_batch.call_count, 2)
+        self.assertEqual(raised.exception.incomplete_pages, ["9-12"])
+        self.assertEqual(raised.exception.token_usage, 20)
+
+    def test_text_fallback_is_skipped_when_token_budget_is_spent(self):
+        text = MagicMock(return_value=(TEXT_CHANGES, 50))
+        with patch('pdf_to_word_api.extract_changes_from_pdf', return_value=([], 100)), \
+                patch('pdf_to_word_api.extract_changes_from_text', text):
+            self.assertEqual(extract_changes("doc.pdf", "doc.pdf", MagicMock(), token_budget=100), ([], 100))
+            text.assert_not_called()
+            self.assertEqual(extract_changes("doc.pdf", "doc.pdf", MagicMock(), token_budget=200),
+                             (TEXT_CHANGES, 150))
+
+    def test_incomplete_vision_result_is_surfaced_by_every_policy(self):
+        incomplete = pdf_to_word_api.IncompleteExtraction(VISION_CHANGES, 100, ["5-8"])
+        for policy in pdf_to_word_api.hedge_policies:
+            with self.subTest(policy=policy), \
+                    patch('pdf_to_word_api.extract_changes_from_pdf', side_effect=incomplete), \
+                    patch('pdf_to_word_api.extract_changes_from_text', return_value=([], 50)):
+                with self.assertRaises(pdf_to_word_api.IncompleteExtraction) as raised:
+                    extract_changes("doc.pdf", "doc.pdf", MagicMock(), policy, 60)
+                self.assertEqual(raised.exception.incomplete_pages, ["5-8"])
+                self.assertEqual(raised.exception.changes, VISION_CHANGES)
+
+        # Text-layer changes cover every page, so a hedged extraction can use them instead
+        with patch('pdf_to_word_api.extract_changes_from_pdf', side_effect=incomplete), \
+                patch('pdf_to_word_api.extract_changes_from_text', return_value=(TEXT_CHANGES, 50)):
+            changes, _ = extract_changes("doc.pdf", "doc.pdf", MagicMock(), "first", 60)
+        self.assertEqual(changes, TEXT_CHANGES)
+
+    def test_convert_reports_incomplete_pages(self):
+        pdf_path = "pdf/3. VI_2 (Tracked Changes).pdf"
+        if not os.path.exists(pdf_path):
+            self.skipTest(f"PDF file not found: {pdf_path}")
+
+        client = pdf_to_word_api.create_app().test_client()
+        incomplete = pdf_to_word_api.IncompleteExtraction(VISION_CHANGES, 100, ["5-8"])
+        with patch('pdf_to_word_api.extract_changes', side_effect=incomplete), \
+                patch('pdf_to_word_api.log_api_call'), \
+                open(pdf_path, "rb") as pdf, open("word/template.docx", "rb") as template:
+            response = client.post("/convert", data={"file": (pdf, "doc.pdf"), "template": (template, "t.docx")})
+
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(response.json["incomplete_pages"], ["5-8"])
+
+
+class TestBatchConvert(unittest.TestCase):
+
+    def test_resumes_from_manifest(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            input_dir = os.path.join(work_dir, "archive")
+            os.makedirs(os.path.join(input_dir, "sub"))
+            for name in ("a.pdf", os.path.join("sub", "b.pdf"), "notes.txt"):
+                with open(os.path.join(input_dir, name), "wb") as f:
+                    f.write(name.encode())
+            manifest_path = os.path.join(work_dir, "manifest.jsonl")
+
+            def extract(pdf_path, pdf_filename, *args, **kwargs):
+                if pdf_filename == "b.pdf":
+                    raise Exception("Azure OpenAI API error: 500")
+                return [{"paragraph_number": "1.", "content": "changed"}], 100
+
+            with patch('pdf_to_word_api.extract_changes', side_effect=extract), \
+                    patch('pdf_to_word_api.save_word_document', return_value=("out.docx", "result/out.docx")), \
+                    patch('pdf_to_word_api.log_api_call'):
+                counts = batch_convert.run(input_dir, "template.docx", "result", manifest_path, 2, "off")
+                self.assertEqual(counts, {"done": 1, "no_changes": 0, "partial": 0, "failed": 1, "over_budget": 0})
+
+                # Only the failed document is processed again
+                with patch('pdf_to_word_api.extract_changes', return_value=([], 10)) as mock_extract:
+                    counts = batch_convert.run(input_dir, "template.docx", "result", manifest_path, 2, "off")
+                self.assertEqual(mock_extract.call_count, 1)
+                self.assertEqual(counts, {"done": 0, "no_changes": 1, "partial": 0, "failed": 0, "over_budget": 0})
+
+            records = batch_convert.load_manifest(manifest_path)
+            self.assertEqual(records["a.pdf"]["status"], "done")
+            self.assertEqual(records[os.path.join("sub", "b.pdf")]["status"], "no_changes")
+
+    def test_documents_finished_after_interrupt_are_recorded(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            input_dir = os.path.join(work_dir, "archive")
+            os.makedirs(input_dir)
+            for name in ("a.pdf", "b.pdf"):
+                with open(os.path.join(input_dir, name), "wb") as f:
+                    f.write(name.encode())
+            manifest_path = os.path.join(work_dir, "manifest.jsonl")
+
+            b_started = threading.Event()
+
+            def convert_one(input_dir, relative_path, doc_hash, *args):
+                if relative_path == "a.pdf":
+                    b_started.wait(5)
+                    raise KeyboardInterrupt  # Delivered to the main thread by future.result()
+                b_started.set()
+                time.sleep(0.2)
+                return {"pdf": relative_path, "sha256": doc_hash, "status": "done", "token_usage": 100,
+                        "seconds": 0.2}
+
+            with patch('batch_convert.convert_one', side_effect=convert_one):
+                with self.assertRaises(KeyboardInterrupt):
+                    batch_convert.run(input_dir, "template.docx", "result", manifest_path, 2, "off")
+
+            records = batch_convert.load_manifest(manifest_path)
+            self.assertEqual(sorted(records), ["b.pdf"])
+            self.assertEqual(records["b.pdf"]["status"], "done")
+
+    def test_document_with_failing_batch_is_partial_and_resumed(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            input_dir = os.path.join(work_dir, "archive")
+            os.makedirs(input_dir)
+            with open(os.path.join(input_dir, "a.pdf"), "wb") as f:
+                f.write(b"a.pdf")
+            manifest_path = os.path.join(work_dir, "manifest.jsonl")
+
+            def failing_last_batch(batch_images, start_page, router, detail):
+                if start_page == 4:
+                    raise Exception("Azure OpenAI API error: 500")
+                return [{"paragraph_number": str(start_page), "content": "changed"}], 10
+
+            def succeeding_batch(batch_images, start_page, router, detail):
+                return [{"paragraph_number": str(start_page), "content": "changed"}], 10
+
+            with patch.multiple(pdf_to_word_api, checkpoint_dir=os.path.join(work_dir, "checkpoints"),
+                                batch_retry_delay=0), \
+                    patch('pdf_to_word_api.convert_pdf_to_images', return_value=list(range(6))), \
+                    patch('pdf_to_word_api.extract_changes_from_text', return_value=([], 0)), \
+                    patch('pdf_to_word_api.save_word_document', return_value=("out.docx", "result/out.docx")) as mock_save, \
+                    patch('pdf_to_word_api.log_api_call'):
+                with patch('pdf_to_word_api.process_image_batch', side_effect=failing_last_batch):
+                    counts = batch_convert.run(input_dir, "template.docx", "result", manifest_path, 1, "off")
+                self.assertEqual(counts["partial"], 1)
+                mock_save.assert_not_called()
+                record = batch_convert.load_manifest(manifest_path)["a.pdf"]
+                self.assertEqual(record["status"], "partial")
+                self.assertEqual(record["incomplete_pages"], ["5-6"])
+
+                # The next run processes the document again and only sends the missing pages
+                with patch('pdf_to_word_api.process_image_batch', side_effect=succeeding_batch) as mock_batch:
+                    counts = batch_convert.run(input_dir, "template.docx", "result", manifest_path, 1, "off")
+                self.assertEqual([c.args[1] for c in mock_batch.call_args_list], [4])
+                self.assertEqual(counts["done"], 1)
+                mock_save.assert_called_once()
+                self.assertEqual([c["paragraph_number"] for c in mock_save.call_args.args[1]], ["0", "4"])
+
+
+class TestTokenEstimator(unittest.TestCase):
+
+    def test_image_tokens(self):
+        # An A4 page at 200 DPI is scaled to 768x1086 and split into 2x3 tiles
+        self.assertEqual(token_estimator.page_pixels(595, 842, 200), (1653, 2339))
+        self.assertEqual(token_estimator.image_tokens(1653, 2339), 85 + 170 * 6)
+        self.assertEqual(token_estimator.image_tokens(595, 842), 85 + 170 * 4)
+        self.assertEqual(token_estimator.image_tokens(1653, 2339, "low"), 85)
+
+    def test_estimate_vision_batches(self):
+        estimate = token_estimator.estimate_vision([(595, 842)] * 6, 200, "high", 4, "", 600)
+        self.assertEqual([b["pages"] for b in estimate["batches"]], ["1-4", "5-6"])
+        self.assertEqual(estimate["batches"][0]["image_tokens"], 4 * 1105)
+
+    def test_sample_pdf_estimate(self):
+        pdf_path = "pdf/3. VI_2 (Tracked Changes).pdf"
+        if not os.path.exists(pdf_path):
+            self.skipTest(f"PDF file not found: {pdf_path}")
+
+        estimate = estimate_tokens(pdf_path)
+        self.assertEqual(estimate["vision"][0]["pages"], 48)
+        # api_log.csv records 63744 tokens for this document at 200 DPI
+        self.assertAlmostEqual(estimate["vision"][0]["total_tokens"], 63744, delta=63744 * 0.2)
+
+    def test_plan_degrades_then_falls_back_to_text(self):
+        estimate = {
+            "vision": [
+                {"dpi": 200, "detail": "high", "total_tokens": 60000},
+                {"dpi": 72, "detail": "high", "total_tokens": 40000},
+                {"dpi": 72, "detail": "low", "total_tokens": 10000},
+            ],
+            "text": {"total_tokens": 5000},
+        }
+        self.assertEqual(plan_extraction(estimate, None)["dpi"], 200)
+        self.assertEqual(plan_extraction(estimate, 50000)["dpi"], 72)
+        # The text-layer extraction can run as well as the vision pass, so it is counted
+        self.assertEqual(plan_extraction(estimate, 44000)["detail"], "low")
+        self.assertEqual(plan_extraction(estimate, 44000)["estimated_tokens"], 15000)
+        self.assertEqual(plan_extraction(estimate, 8000)["mode"], "text")
+        self.assertIsNone(plan_extraction(estimate, 1000))
+
+    def test_estimate_endpoint(self):
+        pdf_path = "pdf/3. VI_2 (Tracked Changes).pdf"
+        if not os.path.exists(pdf_path):
+            self.skipTest(f"PDF file not found: {pdf_path}")
+
+        client = pdf_to_word_api.create_app().test_client()
+        with open(pdf_path, "rb") as f:
+            response = client.post("/estimate", data={"file": (f, "doc.pdf"), "token_budget": "50000"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["plan"]["dpi"], 72)
+        self.assertEqual(len(response.json["estimate"]["vision"]), len(pdf_to_word_api.degrade_steps))
+
+
+class TestAppFactory(unittest.TestCase):
+
+    def test_heavy_modules_are_not_imported_at_startup(self):
+        code = ("import sys, pdf_to_word_api; pdf_to_word_api.create_app(); "
+                "print(','.join(m for m in ('requests', 'pdfplumber', 'pdf2image', 'docx', 'pypdfium2') if m in sys.modules))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.strip(), "")
+
+    def test_config_overrides(self):
+        app = pdf_to_word_api.create_app({
+            "AZURE_OPENAI_DEPLOYMENT_TIERS": [[{"deployment_id": "only"}]],
+            "HEDGE_POLICY": "merge",
+        })
+        self.assertEqual(app.extensions["deployment_router"].describe(), "only")
+
+        response = app.test_client().post("/convert", data={})
+        self.assertEqual(response.status_code, 400)
+
+        with self.assertRaises(ValueError):
+            pdf_to_word_api.create_app({"HEDGE_POLICY": "fastest"})
+        with self.assertRaises(ValueError):
+            pdf_to_word_api.create_app({"AZURE_OPENAI_API_KEY": None})
+        for budget in (0, -100):
+            with self.assertRaises(ValueError):
+                pdf_to_word_api.create_app({"TOKEN_BUDGET": budget})
+
+    def test_deployment_config_uses_environment_names(self):
+        app = pdf_to_word_api.create_app({"AZURE_OPENAI_DEPLOYMENT": "gpt-4o-eu"})
+        self.assertEqual(app.extensions["deployment_router"].describe(), "chat-gpt-4o-mini > gpt-4o-eu")
+
+        tiers_json = '[[{"deployment_id": "a"}, {"deployment_id": "b"}]]'
+        app = pdf_to_word_api.create_app({"AZURE_OPENAI_DEPLOYMENT_TIERS": tiers_json})
+        self.assertEqual(app.extensions["deployment_router"].describe(), "a|b")
+
+    def test_process_wide_config_overrides(self):
+        with tempfile.TemporaryDirectory() as checkpoint_dir, \
+                patch.multiple(pdf_to_word_api, checkpoint_dir=pdf_to_word_api.checkpoint_dir,
+                               hedge_workers=pdf_to_word_api.hedge_workers):
+            app = pdf_to_word_api.create_app({"CHECKPOINT_DIR": checkpoint_dir, "HEDGE_WORKERS": 3})
+            self.assertEqual(app.config["HEDGE_WORKERS"], 3)
+            self.assertTrue(pdf_to_word_api.batch_checkpoint_path("abc", 0, 4).startswith(checkpoint_dir))
+            self.assertEqual(pdf_to_word_api.hedge_executor()._max_workers, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import math
+
+# Vision token accounting for GPT-4o class models: a "high" detail image is scaled to fit
+# within 2048x2048, then its shortest side is scaled down to 768px, and it costs a base
+# amount plus a fixed amount per 512px tile. A "low" detail image costs the base amount only.
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+IMAGE_MAX_SIDE = 2048
+IMAGE_SHORT_SIDE = 768
+
+# Rough average for English text with the GPT-4o tokenizer
+CHARS_PER_TOKEN = 4
+
+# Tokens used by the chat message framing of each request
+MESSAGE_OVERHEAD_TOKENS = 10
+
+
+def text_tokens(text):
+    """Estimates the number of tokens in a piece of text."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def page_pixels(width_pt, height_pt, dpi):
+    """Returns the pixel size of a page of width_pt x height_pt points rendered at dpi."""
+    return round(width_pt * dpi / 72), round(height_pt * dpi / 72)
+
+
+def image_tokens(width, height, detail="high"):
+    """Returns the input tokens of an image of width x height pixels at the given detail level."""
+    if detail == "low":
+        return IMAGE_BASE_TOKENS
+
+    scale = min(1.0, IMAGE_MAX_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, IMAGE_SHORT_SIDE / min(width, height))
+    width, height = width * scale, height * scale
+
+    tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+def read_pdf_layout(pdf_path):
+    """
+    Returns the page sizes in points and the number of characters in the text layer of a PDF, without rendering it.
+    Uses pdfium rather than pdfplumber, which is much slower because it lays out every character.
+    """
+    import pypdfium2  # Installed with pdfplumber
+
+    page_sizes = []
+    text_length = 0
+    pdf = pypdfium2.PdfDocument(pdf_path)
+    try:
+        for index in range(len(pdf)):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            page_sizes.append(page.get_size())
+            text_length += textpage.count_chars() + 1
+            textpage.close()
+            page.close()
+    finally:
+        pdf.close()
+    return page_sizes, text_length
+
+
+def estimate_vision(page_sizes, dpi, detail, batch_size, prompt, expected_output_tokens):
+    """
+    Estimates the tokens of the image-based extraction, per batch and in total.
+    `prompt` is the text sent with every batch; `expected_output_tokens` is the expected
+    completion size per batch.
+    """
+    prompt_tokens = text_tokens(prompt) + MESSAGE_OVERHEAD_TOKENS
+    batches = []
+    for start in range(0, len(page_sizes), batch_size):
+        batch_pages = page_sizes[start:start+batch_size]
+        batch_image_tokens = sum(image_tokens(*page_pixels(w, h, dpi), detail) for w, h in batch_pages)
+        batches.append({
+            "pages": f"{start+1}-{start+len(batch_pages)}",
+            "image_tokens": batch_image_tokens,
+            "text_tokens": prompt_tokens,
+            "output_tokens": expected_output_tokens,
+            "total_tokens": batch_image_tokens + prompt_tokens + expected_output_tokens,
+        })
+
+    return {
+        "dpi": dpi,
+        "detail": detail,
+        "pages": len(page_sizes),
+        "batches": batches,
+        "total_tokens": sum(batch["total_tokens"] for batch in batches),
+    }
+
+
+def estimate_text(text_length, prompt, expected_output_tokens):
+    """Estimates the tokens of the text-layer extraction, which sends the whole text layer in one request."""
+    input_tokens = math.ceil(text_length / CHARS_PER_TOKEN) + text_tokens(prompt) + MESSAGE_OVERHEAD_TOKENS
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": expected_output_tokens,
+        "total_tokens": input_tokens + expected_output_tokens,
+    }